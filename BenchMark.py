@@ -0,0 +1,254 @@
+# Benchmarks of the NumPy engines on seeded synthetic terrain instead of the D:\SA geodatabase.
+# Terrain: a diamond-square fractal DEM on a regional tilt with meandering valleys carved in, pits filled by a
+# priority flood; flow direction (ESRI D8), slope and pour points (every 10 m of height along the streams) follow from it.
+# Stages timed at each DEM size:
+#   landsep - PinkArray.landsweep over all heads and slopes (cells/s, one cell per head and slope)
+#   screen  - GullyArray: all watersheds labelled at once, then per pour point the hypsometric curve and, for sites
+#             above minrescells, the grid metrics and footprint, as DryGully.screen with the "NumPy" engines (points/s)
+#   removal - SetArray.overlapremoval on footprints of synthetic sites at several site counts (pairs/s, exact tests)
+# Peak memory is traced (tracemalloc, Python 3) in a second run of each stage, so the timings are not slowed by it.
+# Check 1 to 10 before running the script.
+# Output: benchmark.csv
+# Bug reports to: bin.lu@anu.edu.au
+
+import os
+import csv
+import heapq
+import timeit
+import numpy as np
+import datetime as dt
+import PinkArray
+import GullyArray
+import SetArray
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Set working directory and benchmark parameters
+directory = "." # Check 1
+seed = 2017 # Check 2 - Seed of the synthetic terrain and sites
+sizes = [257, 513, 1025] # Check 3 - DEM sizes in cells (2^n + 1)
+heads = range(200, 501, 100) # Check 4 - Altitude difference of landsep
+slopes = [15] # Check 5 - Head to horizontal distance ratio of landsep
+resolution = 30 # Check 6 - Cell size in metres (1 arc-second)
+maxdamheight = 40 # Check 7 - Max dam height of screen
+minrescells = 111 # Check 8 - Min reservoir cells of screen
+sitecounts = [1000, 10000, 50000] # Check 9 - Site counts of removal
+memory = True # Check 10 - True to trace the peak memory of each stage
+
+
+def diamondsquare(size, roughness, rng):
+
+    # Fractal surface of size x size cells (size = 2^n + 1) in [0, 1]
+    dem = np.zeros((size, size))
+    dem[::size - 1, ::size - 1] = rng.random_sample((2, 2))
+    step, scale = size - 1, 1.0
+    while step>1:
+        half = step // 2
+
+        # Diamond step: centres of the squares
+        corners = dem[0:-1:step, 0:-1:step] + dem[0:-1:step, step::step] + dem[step::step, 0:-1:step] + dem[step::step, step::step]
+        dem[half::step, half::step] = corners / 4 + (rng.random_sample(corners.shape) - 0.5) * scale
+
+        # Square step: midpoints of the edges, from the (up to four) neighbours on the grid
+        for row0, col0 in [(0, half), (half, 0)]:
+            rows, cols = np.meshgrid(np.arange(row0, size, step), np.arange(col0, size, step), indexing="ij")
+            total, count = np.zeros(rows.shape), np.zeros(rows.shape)
+            for dr, dc in [(-half, 0), (half, 0), (0, -half), (0, half)]:
+                r, c = rows + dr, cols + dc
+                valid = (r>=0) & (r<size) & (c>=0) & (c<size)
+                total[valid] += dem[r[valid], c[valid]]
+                count[valid] += 1
+            dem[rows, cols] = total / count + (rng.random_sample(rows.shape) - 0.5) * scale
+        step, scale = half, scale * roughness
+    return (dem - dem.min()) / (dem.max() - dem.min())
+
+
+def terrain(size, rng, relief=1000.0, valleys=6):
+
+    # Synthetic DEM (m): fractal relief on a tilt towards the bottom row, with meandering valleys carved in
+    rows, cols = np.meshgrid(np.arange(size, dtype=np.float64), np.arange(size, dtype=np.float64), indexing="ij")
+    dem = relief * (0.6 * diamondsquare(size, 0.55, rng) + 0.4 * (1 - rows / size))
+    for k in range(valleys):
+        centre = rng.random_sample() * size
+        amplitude, wavelength = rng.random_sample() * size / 8, (0.3 + rng.random_sample()) * size
+        width, depth = size / 60.0 + 2, relief * (0.05 + 0.1 * rng.random_sample())
+        distance = cols - centre - amplitude * np.sin(2 * np.pi * rows / wavelength)
+        dem -= depth * np.exp(-(distance / width)**2)
+    return dem
+
+
+def priorityflood(dem, epsilon=1e-3):
+
+    # Fill the pits: every cell drains to the edge of the grid along strictly decreasing elevations
+    rows, cols = dem.shape
+    filled = dem.copy()
+    done = np.zeros(dem.shape, dtype=np.bool_)
+    heap = []
+    for r in range(rows):
+        for c in ([0, cols - 1] if 0<r<rows - 1 else range(cols)):
+            heapq.heappush(heap, (filled[r, c], r, c))
+            done[r, c] = True
+    steps = [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc]
+    while heap:
+        elev, r, c = heapq.heappop(heap)
+        for dr, dc in steps:
+            nr, nc = r + dr, c + dc
+            if 0<=nr<rows and 0<=nc<cols and not done[nr, nc]:
+                done[nr, nc] = True
+                filled[nr, nc] = max(filled[nr, nc], elev + epsilon)
+                heapq.heappush(heap, (filled[nr, nc], nr, nc))
+    return filled
+
+
+def flowdirection(filled):
+
+    # ESRI D8 codes of steepest descent; edge cells flow off the grid
+    rows, cols = filled.shape
+    padded = np.pad(filled, 1, mode="constant", constant_values=-np.inf)
+    best, direction = np.zeros(filled.shape), np.zeros(filled.shape, dtype=np.int32)
+    for code, (dr, dc) in GullyArray.d8.items():
+        drop = (filled - padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]) / np.hypot(dr, dc)
+        better = drop>best
+        best[better], direction[better] = drop[better], code
+    return direction
+
+
+def slopedegrees(dem, cellsize):
+
+    # Slope (degrees) of a DEM with square cells of cellsize metres
+    dy, dx = np.gradient(dem, cellsize)
+    return np.degrees(np.arctan(np.hypot(dx, dy)))
+
+
+def pourpoints(filled, direction, mincells, interval=10.0):
+
+    # Pour points: stream cells (at least mincells upstream) where the flow crosses a multiple of interval metres
+    recv = GullyArray.receivers(direction)
+    acc = GullyArray.accumulation(recv, GullyArray.flowlevels(recv))
+    flat = filled.ravel()
+    down = np.maximum(recv, 0)
+    cross = (recv>=0) & (np.floor(flat / interval)!=np.floor(flat[down] / interval))
+    return np.nonzero((acc + 1>=mincells) & cross)[0]
+
+
+def screen(dem, slope, direction, cells, geometry):
+
+    # DryGully.screen with the "NumPy" engines: watersheds at once, then the curve and metrics of every pour point
+    # Return the number of sites above minrescells
+    labels, parents = GullyArray.watersheds(direction, cells, np.arange(1, cells.size + 1))
+    shed = GullyArray.watershedindex(labels, parents, (0.0, 0.0, 1.0))
+    sites = 0
+    for pid in range(1, cells.size + 1):
+        wcells = GullyArray.watershedcells(shed, pid)
+        if wcells.size==0:
+            continue
+        (row0, row1, col0, col1), mask = GullyArray.cellwindow(shed, wcells)
+        elev = np.where(mask, dem[row0:row1, col0:col1], np.nan)
+        area = geometry["area"][row0:row1].mean()
+        curve = GullyArray.hypsometry(elev)
+        level = curve[0][0] + maxdamheight
+        if GullyArray.reservoircurve(curve, [maxdamheight], area, minrescells)["Cells"][0]<minrescells:
+            continue
+        site = GullyArray.sitemetrics(elev, level, slope[row0:row1, col0:col1], dem[row0:row1, col0:col1], geometry, row0)
+        SetArray.cellruns(site["reservoir"], row0, col0, dem.shape[1])
+        sites += 1
+    return sites
+
+
+def syntheticsites(count, rng, density=0.5, maxradius=12):
+
+    # Sites as discs of cells on a grid that grows with count, about density discs overlapping each disc
+    # Return pour points (lat, lon), boxes, water-rock ratios and footprints
+    cellsize = resolution / 111320.0
+    side = int(np.sqrt(count * np.pi * maxradius**2 / density)) + 2 * maxradius
+    rows, cols = rng.randint(maxradius, side - maxradius, count), rng.randint(maxradius, side - maxradius, count)
+    radii = rng.randint(2, maxradius + 1, count)
+    footprints, bbox = [], np.zeros((count, 4))
+    for k in range(count):
+        r = np.arange(-radii[k], radii[k] + 1)
+        disc = r[:, None]**2 + r[None, :]**2<=radii[k]**2
+        footprints.append(SetArray.cellruns(disc, rows[k] - radii[k], cols[k] - radii[k], side))
+        bbox[k] = [(cols[k] - radii[k]) * cellsize, -(rows[k] + radii[k] + 1) * cellsize,
+                   (cols[k] + radii[k] + 1) * cellsize, -(rows[k] - radii[k]) * cellsize]
+    return -rows * cellsize, cols * cellsize, bbox, rng.random_sample(count) * 20, footprints
+
+
+def removal(lat, lon, bbox, ratio, footprints):
+
+    # PrettySet.removalindexed on footprints; return the number of exact overlap tests
+    tests = [0]
+    def intersects(i, j):
+        tests[0] += 1
+        return SetArray.runsoverlap(footprints[i], footprints[j])
+    SetArray.overlapremoval(lat, lon, bbox, ratio, intersects)
+    return tests[0]
+
+
+def measure(stage, *args):
+
+    # Seconds of a stage, its result and its peak traced memory (MB) in a second run, None if not traced
+    start = timeit.default_timer()
+    result = stage(*args)
+    seconds = timeit.default_timer() - start
+    peak = None
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+        stage(*args)
+        peak = tracemalloc.get_traced_memory()[1] / float(2**20)
+        tracemalloc.stop()
+    return seconds, result, peak
+
+
+def report(rows, stage, size, count, seconds, unit, peak):
+
+    # Print and keep one line of the benchmark
+    rate = count / seconds if seconds>0 else float("inf")
+    rows.append([stage, size, count, round(seconds, 3), round(rate, 1), unit, round(peak, 1) if peak is not None else ""])
+    print(stage + " " + str(size) + ": " + str(count) + " in " + str(round(seconds, 3)) + " s, " + str(round(rate, 1)) + " " + unit +
+          (", peak " + str(round(peak, 1)) + " MB" if peak is not None else ""))
+
+
+if __name__=="__main__":
+
+    # Record the start time
+    starttime = dt.datetime.now()
+    print("Begins at: " + str(starttime))
+    rng = np.random.RandomState(seed)
+    rows = []
+
+    for size in sizes:
+
+        # Synthetic terrain and its derived inputs
+        dem = terrain(size, rng)
+        filled = priorityflood(dem)
+        direction = flowdirection(filled)
+        slope = slopedegrees(dem, resolution)
+        cells = pourpoints(filled, direction, minrescells)
+        geometry = GullyArray.rowgeometry(-34.0, resolution / 111320.0, size)
+        print("Terrain " + str(size) + " x " + str(size) + ": " + str(cells.size) + " pour points at " + str(dt.datetime.now()))
+
+        # landsep over all heads and slopes
+        seconds, masks, peak = measure(PinkArray.landsweep, heads, slopes, resolution, dem.astype(np.float32))
+        report(rows, "landsep", size, dem.size * len(masks), seconds, "cells/s", peak)
+
+        # screen per pour point
+        seconds, sites, peak = measure(screen, dem, slope, direction, cells, geometry)
+        report(rows, "screen", size, cells.size, seconds, "points/s", peak)
+        print(str(sites) + " sites above " + str(minrescells) + " cells")
+
+    # removal across site counts
+    for count in sitecounts:
+        seconds, tests, peak = measure(removal, *syntheticsites(count, rng))
+        report(rows, "removal", count, tests, seconds, "pairs/s", peak)
+
+    # Save the benchmark
+    with open(os.path.join(directory, "benchmark.csv"), "w") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Stage", "Size", "Count", "Seconds", "Throughput", "Unit", "Peak_MB"])
+        writer.writerows(rows)
+
+    # Calculate the running time
+    endtime = dt.datetime.now()
+    print("Running time: " + str(endtime - starttime))
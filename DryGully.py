@@ -7,6 +7,19 @@
 # 6. Store "appt" in memory instead of geodatabase.
 # 7. Add "resdomain", "resslp", "damdem" for ExtractByAttributes and ExtractByMask.
 # 8. Allow detailed info on arcpy.ExecuteError, RuntimeError to be plotted in IDLE.
+# 9. Screen pour points on a pool of processes, each with its own scratch geodatabase; results merged in OBJECTID order.
+# 10. Label the watersheds of all pour points in one pass over the flow-direction grid (GullyArray) instead of Watershed per point.
+# 11. Read the reservoirs of several dam heights off one hypsometric curve per watershed (damheights.csv).
+# 12. Measure reservoirs and dams on the grid (GullyArray) instead of RasterToPolygon/Intersect/Project per site.
+# 13. Save the footprint of each reservoir as runs of cells on the highland grid, and the grid (footprints.npz) for PrettySet.
+# 14. Journal the outcome of every pour point (journal.csv, rows closed by a checksum) so that an interrupted screen can be resumed.
+# 15. Write the sites in batches to a typed, indexed SQLite store (sites.sqlite) instead of one records.csv row at a time.
+# 16. Create RES_ from a typed (DOUBLE) template and write its attributes in one cursor pass instead of AddField/CalculateField.
+# 17. Append all reservoirs and dams to RESERVOIRS and DAMS keyed by PPT_ID instead of RES_1234/DAM_1234 (Check 17).
+# 18. Skip the pour points with fewer upstream cells than minrescells, counted on the watershed index or sampled from FlowAccumulation (Check 18).
+# 19. Screen the pour points along a Hilbert curve and read highland/landslope through an LRU tile cache (Check 19, 20).
+# 20. Reject the pour points of nested watersheds on memoized label elevations before any extraction (Check 21).
+# 21. Time every stage of every pour point in named spans: trace.jsonl and trace_summary.csv (Check 22).
 # Bug reports to: bin.lu@anu.edu.au
 
 import os
@@ -14,182 +27,756 @@ import sys
 import arcpy
 import math
 import csv
+import zlib
 import traceback
+import numpy
+import multiprocessing
 import datetime as dt
-from Interface import directory, highland, direction, points, landslope, maxdamheight, minrescells, dambatter, screenrange
+import GullyArray
+import SetArray
+import SiteStore
+import StageTime
+from Interface import directory, geodatabase, highland, direction, points, landslope, maxdamheight, minrescells, dambatter, screenrange, processes
+from Interface import watershedengine, damheights, metricsengine, resume, store, output, prefilter, schedule, cachetiles, memocells
+from Interface import tracing
 
+# Batch watershed index of the "NumPy" watershed engine
+shed = None
 
-def screen():
+# Geodesic row lookup of the "NumPy" metrics engine
+geometry = None
+
+# RES_ templates created in this process (one per workspace)
+templates = set()
+
+# Raster tile cache of the "NumPy" engines (one per process)
+tiles = None
+
+# Memoized label elevations of the "NumPy" watershed engine (one per process)
+memo = None
+
+# Stage timing
+StageTime.enabled["on"] = tracing
+
+
+def prepwatersheds():
+
+    # Label the watersheds of all pour points in one pass over the flow-direction grid; the index is saved for the workers
+    global shed
+    fdr = arcpy.Raster(direction)
+    transform = (fdr.extent.XMin, fdr.extent.YMax, fdr.meanCellWidth)
+    array = arcpy.RasterToNumPyArray(fdr, nodata_to_value=0)
+    with arcpy.da.SearchCursor(points, ["OBJECTID", "POINT_X", "POINT_Y"]) as cursor:
+        oids, xs, ys = zip(*[row for row in cursor])
+    cells = GullyArray.pourcells(xs, ys, transform, array.shape)
+    labels, parents = GullyArray.watersheds(array, cells, oids)
+    del array
+    shed = GullyArray.watershedindex(labels, parents, transform)
+    GullyArray.savewatersheds(os.path.join(directory, "watersheds"), shed)
+    print "Watersheds of " + str(len(oids)) + " pour points labelled at " + str(dt.datetime.now())
+
+
+def upstreamcells(oids):
+
+    # Upstream cells of each pour point, the pour point cell included: {OBJECTID: cells}
+    # "NumPy" adds up the cells of its nested labels in the watershed index of prepwatersheds;
+    # "ArcGIS" samples FlowAccumulation at the pour points (ExtractValuesToPoints), without reading the grid into memory
+    screenset = set(oids)
+    if watershedengine=="NumPy":
+        counts = GullyArray.upstreamcounts(shed)
+        return dict((oid, counts[oid]) for oid in oids if counts.get(oid, 0)>0) # Points sharing a cell are kept
+    arcpy.env.extent = direction # Accumulate over the whole grid, on the cells of the flow-direction raster
+    arcpy.gp.FlowAccumulation_sa(direction, "flowacc")
+    arcpy.gp.ExtractValuesToPoints_sa(points, "flowacc", "pointacc")
+    arcpy.env.extent = points
+    with arcpy.da.SearchCursor("pointacc", ["POINT_X", "POINT_Y", "RASTERVALU"]) as cursor:
+        acc = dict(((row[0], row[1]), row[2]) for row in cursor)
+    with arcpy.da.SearchCursor(points, ["OBJECTID", "POINT_X", "POINT_Y"]) as cursor:
+        rows = [row for row in cursor if row[0] in screenset]
+    return dict((oid, int(acc[(x, y)]) + 1) for oid, x, y in rows if acc.get((x, y)) is not None and acc[(x, y)]>=0)
+
+
+def prefilterpoints(oids):
+
+    # Drop the pour points whose whole watershed is smaller than minrescells: no reservoir can reach it
+    # The dropped points are journalled as rejected, so a resumed screen skips them too
+    counts = upstreamcells(oids)
+    pruned = [oid for oid in oids if counts.get(oid, minrescells)<minrescells]
+    with open(os.path.join(directory, "journal.csv"), "a") as journal:
+        journalwrite(journal, [(oid, "rejected", str(counts[oid]) + " upstream cells", None) for oid in pruned])
+    print "Prefilter: " + str(len(pruned)) + " of " + str(len(oids)) + " pour points pruned (fewer than " + str(minrescells) + " upstream cells)"
+    pruned = set(pruned)
+    return [oid for oid in oids if oid not in pruned]
+
+
+def cellbox(latitude, longitude):
+
+    # Cell window (row0, row1, col0, col1) of the Processing Extent of a pour point on the flow-direction grid
+    left, top, cellsize = shed["transform"]
+    return (int(math.floor((top - latitude - 0.05) / cellsize)), int(math.ceil((top - latitude + 0.05) / cellsize)),
+            int(math.floor((longitude - 0.05 - left) / cellsize)), int(math.ceil((longitude + 0.05 - left) / cellsize)))
+
+
+def wshedraster(oid, latitude, longitude):
+
+    # Watershed of a pour point from the batch labels within its Processing Extent as the raster "wshed",
+    # or None if another point shares its cell
+    cells = GullyArray.watershedcells(shed, oid, cellbox(latitude, longitude))
+    if cells.size==0:
+        return None
+    window, mask = GullyArray.cellwindow(shed, cells)
+    left, top, cellsize = shed["transform"]
+    lowerleft = arcpy.Point(left + window[2] * cellsize, top - window[1] * cellsize)
+    arcpy.NumPyArrayToRaster(mask.astype(numpy.uint8), lowerleft, cellsize, cellsize, 0).save("wshed")
+    arcpy.DefineProjection_management("wshed", arcpy.Describe(direction).spatialReference)
+    return "wshed"
+
+
+def polygonmetrics(oid, watershed, reservoir):
+
+    # Reservoir and dam metrics from polygons projected to GDA 1994 Geoscience Australia Lambert
+    # Return the reservoir polygon, water area (ha), mean slope, mean reservoir DEM, dam length (m) and mean dam DEM
+    with StageTime.span("RasterToPolygon"):
+        watershed_polygon = arcpy.RasterToPolygon_conversion(in_raster=watershed * 0,
+                                                             out_polygon_features="wshedpolygon",
+                                                             simplify="NO_SIMPLIFY")
+        reservoir = arcpy.Raster(reservoir)
+        reservoir_polygon = arcpy.RasterToPolygon_conversion(in_raster=reservoir * 0,
+                                                             out_polygon_features="respolygon",
+                                                             simplify="NO_SIMPLIFY")
+       
+    # If there is an isolated tiny polygon?
+    with StageTime.span("LargestPolygon"):
+        rescount = int(arcpy.GetCount_management(reservoir_polygon).getOutput(0))
+        if rescount>1:
+            with arcpy.da.SearchCursor(reservoir_polygon, "SHAPE_AREA") as cursor:
+                maxresarea = max([a[0] for a in cursor])
+            lyrres = arcpy.MakeFeatureLayer_management(in_features=reservoir_polygon, out_layer="areslayer",
+                                                       where_clause="SHAPE_AREA = " + str(maxresarea)) # a layer of a polygon
+            reservoir_polygon = arcpy.CopyFeatures_management(in_features=lyrres, out_feature_class="respolygon1")
+        assert int(arcpy.GetCount_management(reservoir_polygon).getOutput(0))==1
+
+    # Calculate the average slope of a reservoir
+    with StageTime.span("SlopeByMask"):
+        resslope = arcpy.gp.ExtractByMask_sa(landslope, reservoir_polygon, "resslp") # Get the DEM of a watershed
+        resslope = arcpy.Raster(resslope)
+
+    # Project to GDA 1994 Geoscience Australia Lambert: 3112
+    # GCS_WGS_1984: 4326
+    with StageTime.span("ProjectReservoir"):
+        reservoir_polygongda94 = arcpy.Project_management(in_dataset=reservoir_polygon,
+                                                          out_dataset="respolygongda94",
+                                                          out_coor_system=arcpy.SpatialReference(3112),
+                                                          transform_method="GDA_1994_To_WGS_1984",
+                                                          in_coor_system=arcpy.SpatialReference(4326))
+    
+        # Calculate the area of a reservoir (in hectares)
+        with arcpy.da.SearchCursor(reservoir_polygongda94, "SHAPE_AREA") as cursor:
+            waterarea = cursor.next()[0] * pow(10, -4) # hectares
+
+    # Build a dam
+    with StageTime.span("Intersect"):
+        dam_polyline = arcpy.Intersect_analysis(in_features=[watershed_polygon, reservoir_polygon],
+                                                out_feature_class=sitename("DAM", oid),
+                                                output_type="LINE")
+
+    # Project to GDA 1994 Geoscience Australia Lambert: 3112
+    # GCS_WGS_1984: 4326
+    with StageTime.span("ProjectDam"):
+        dam_polylinegda94 = arcpy.Project_management(in_dataset=dam_polyline,
+                                                     out_dataset="dampolylinegda94",
+                                                     out_coor_system=arcpy.SpatialReference(3112),
+                                                     transform_method="GDA_1994_To_WGS_1984",
+                                                     in_coor_system=arcpy.SpatialReference(4326))
+
+        # Calculate the length of a dam in metres
+        with arcpy.da.SearchCursor(dam_polylinegda94, "SHAPE_LENGTH") as cursor:
+            damlength = cursor.next()[0] # metres
+
+    # Get the DEM of a dam
+    with StageTime.span("DamByMask"):
+        dam = arcpy.gp.ExtractByMask_sa(highland, dam_polyline, "damdem")
+        dam = arcpy.Raster(dam)
+
+    return reservoir_polygon, waterarea, resslope.mean, reservoir.mean, damlength, dam.mean
+
+
+def windowarray(raster, watershed):
+
+    # Read a raster on the window of a watershed raster, NoData as NaN
+    lowerleft = arcpy.Point(watershed.extent.XMin, watershed.extent.YMin)
+    array = arcpy.RasterToNumPyArray(raster, lowerleft, watershed.width, watershed.height, -9999).astype(numpy.float64)
+    array[array==-9999] = numpy.nan
+    return array
+
+
+def gridwindow(raster, watershed):
+
+    # Read an input raster (highland, landslope) on the window of a watershed raster through the tile cache, NoData as NaN
+    return cachewindow(raster, watershed.extent.YMax, watershed.extent.XMin, watershed.height, watershed.width)
+
+
+def cachewindow(raster, wtop, wleft, rows, cols):
+
+    # Read rows x cols cells of an input raster from the top left corner (wleft, wtop) through the tile cache
+    global tiles
+    if tiles is None:
+        tiles = GullyArray.tilecache(cachetiles)
+    if raster not in tiles["rasters"]:
+        grid = arcpy.Raster(raster)
+        left, top, cellsize = grid.extent.XMin, grid.extent.YMax, grid.meanCellWidth
+        def read(row0, row1, col0, col1):
+            lowerleft = arcpy.Point(left + col0 * cellsize, top - row1 * cellsize)
+            array = arcpy.RasterToNumPyArray(grid, lowerleft, col1 - col0, row1 - row0, -9999).astype(numpy.float64)
+            array[array==-9999] = numpy.nan
+            return array
+        GullyArray.cacheraster(tiles, raster, read, (grid.height, grid.width), (left, top, cellsize))
+    left, top, cellsize = tiles["rasters"][raster][2]
+    row0 = int(round((top - wtop) / cellsize))
+    col0 = int(round((wleft - left) / cellsize))
+    return GullyArray.cachedwindow(tiles, raster, row0, row0 + rows, col0, col0 + cols)
+
+
+def memoscreen(oid, latitude, longitude):
+
+    # Screen a pour point on the memoized elevations of its nested watersheds within the Processing Extent
+    # Return the outcome of a rejected point, or None to go on with the extraction
+    global memo
+    left, top, cellsize = shed["transform"]
+    if memo is None:
+        def read(row0, row1, col0, col1):
+            return cachewindow(highland, top - row0 * cellsize, left + col0 * cellsize, row1 - row0, col1 - col0)
+        memo = GullyArray.watershedmemo(shed, read, memocells)
+    pieces = GullyArray.nestedelevations(memo, oid, cellbox(latitude, longitude))
+    if not pieces:
+        return None
+    elevpoint = min(p[0] for p in pieces)
+    cells = sum(int(numpy.searchsorted(p, elevpoint + maxdamheight, side="right")) for p in pieces)
+    if cells>=minrescells:
+        return None
+    curve = None
+    if damheights:
+        area = GullyArray.cellarea(latitude - cellsize / 2, latitude + cellsize / 2, cellsize)
+        curve = GullyArray.reservoircurve(GullyArray.hypsometry(numpy.concatenate(pieces)), damheights, area, minrescells)
+    print "RES_" + str(oid) + ": " + str(cells) + " cells"
+    return {"status": "rejected", "reason": str(cells) + " cells", "curve": curve}
+
+
+def highlandgrid():
+
+    # Geodesic row lookup of the highland grid, with its left edge and number of columns
+    global geometry
+    if geometry is None:
+        dem = arcpy.Raster(highland)
+        geometry = GullyArray.rowgeometry(dem.extent.YMax, dem.meanCellHeight, dem.height)
+        geometry["left"], geometry["cols"] = dem.extent.XMin, dem.width
+    return geometry
+
+
+def windoworigin(watershed):
+
+    # First row and column of the window of a watershed raster on the highland grid
+    grid = highlandgrid()
+    return (int(round((grid["top"] - watershed.extent.YMax) / grid["cellsize"])),
+            int(round((watershed.extent.XMin - grid["left"]) / grid["cellsize"])))
+
+
+def footprint(watershed, level):
+
+    # Cell runs of the largest reservoir polygon on the highland grid
+    row0, col0 = windoworigin(watershed)
+    area = highlandgrid()["area"][row0:row0 + watershed.height]
+    keep = GullyArray.largestreservoir(windowarray(watershed, watershed), level, area)[1]
+    return SetArray.cellruns(keep, row0, col0, highlandgrid()["cols"]) if keep is not None else None
+
+
+def gridmetrics(oid, watershed, level):
+
+    # Reservoir and dam metrics on the grid with the geodesic row lookup; only the kept reservoir becomes a polygon
+    # Return the same values as polygonmetrics and the footprint of the reservoir
+    with StageTime.span("GridMetrics"):
+        row0, col0 = windoworigin(watershed)
+        site = GullyArray.sitemetrics(windowarray(watershed, watershed), level, gridwindow(landslope, watershed),
+                                      gridwindow(highland, watershed), highlandgrid(), row0)
+        assert site is not None # No reservoir cells below the level, as the polygon path asserts one reservoir polygon
+
+    # Reservoir polygon from the largest reservoir
+    left, top, cellsize = watershed.extent.XMin, watershed.extent.YMax, watershed.meanCellWidth
+    sr = watershed.spatialReference
+    with StageTime.span("RasterToPolygon"):
+        arcpy.NumPyArrayToRaster(site["reservoir"].astype(numpy.uint8), arcpy.Point(left, watershed.extent.YMin),
+                                 cellsize, cellsize, 0).save("reskeep")
+        arcpy.DefineProjection_management("reskeep", sr)
+        reservoir_polygon = arcpy.RasterToPolygon_conversion(in_raster="reskeep", out_polygon_features="respolygon",
+                                                             simplify="NO_SIMPLIFY")
+
+    # Dam polyline from the cell edges joined into continuous paths, so Buffer (FLAT) leaves no notches at the corners
+    with StageTime.span("DamPolyline"):
+        arcpy.CreateFeatureclass_management(arcpy.env.workspace, sitename("DAM", oid), "POLYLINE", spatial_reference=sr)
+        parts = arcpy.Array([arcpy.Array([arcpy.Point(left + c * cellsize, top - r * cellsize) for r, c in path])
+                             for path in GullyArray.segmentpaths(site["segments"])])
+        with arcpy.da.InsertCursor(sitename("DAM", oid), ["SHAPE@"]) as cursor:
+            cursor.insertRow([arcpy.Polyline(parts, sr)])
+
+    cells = SetArray.cellruns(site["reservoir"], row0, col0, highlandgrid()["cols"])
+    return reservoir_polygon, site["waterarea"] * pow(10, -4), site["slopemean"], site["resmean"], site["damlength"], site["dammean"], cells
+
+
+def screenpoint(oid):
+
+    # Screen one pour point: RES_/DAM_ and the scratch datasets are written to the current workspace
+    # Return the outcome: {"status": "written"/"rejected", "reason", "record", "curve" (with damheights), "runs" (footprint)}
+
+    # Select a pour point from the layer
+    with StageTime.span("SelectPoint"):
+        arcpy.env.extent = points # Recover the Processing Extent
+        lyrpp = arcpy.MakeFeatureLayer_management(in_features=points, out_layer="pptlayer",
+                                                  where_clause="OBJECTID = " + str(oid)) # a layer of a pour point
+        point = arcpy.CopyFeatures_management(in_features=lyrpp, out_feature_class=os.path.join("in_memory", "appt" + str(oid)))
+
+        # Get the coordinates
+        cursor = arcpy.SearchCursor(point)
+        row = cursor.next()
+        latitude = row.getValue("POINT_Y")
+        longitude = row.getValue("POINT_X")
+
+    # Reduce the Processing Extent
+    arcpy.env.extent = arcpy.Extent(longitude-0.05, latitude+0.05, longitude+0.05, latitude-0.05)
+
+    # Nested watersheds of the "NumPy" engine: most pour points are rejected before any extraction
+    if shed is not None:
+        with StageTime.span("NestedMemo"):
+            site = memoscreen(oid, latitude, longitude)
+        if site is not None:
+            return site
+
+    # Calculate watershed and reservoir
+    with StageTime.span("Watershed"):
+        watershed = wshedraster(oid, latitude, longitude) if shed is not None else None # Batch labels of the "NumPy" engine
+        if watershed is None:
+            watershed = arcpy.gp.Watershed_sa(direction, point, "wshed", "OBJECTID") # Define a watershed
+    with StageTime.span("ExtractByMask"):
+        watershed = arcpy.gp.ExtractByMask_sa(highland, watershed) # Get the DEM of a watershed
+        watershed = arcpy.Raster(watershed)
+        elevpoint = watershed.minimum
+    if elevpoint==None:
+        print "Watershed of Point " + str(oid) + " is None (ignored)."
+        return {"status": "rejected", "reason": "Watershed is None"}
+
+    # Read the reservoirs of all dam heights off the hypsometric curve
+    curve = None
+    if damheights:
+        with StageTime.span("Curve"):
+            elev = arcpy.RasterToNumPyArray(watershed).astype(numpy.float64)
+            elev[elev==watershed.noDataValue] = numpy.nan
+            area = GullyArray.cellarea(latitude - watershed.meanCellHeight / 2, latitude + watershed.meanCellHeight / 2, watershed.meanCellWidth)
+            curve = GullyArray.reservoircurve(GullyArray.hypsometry(elev), damheights, area, minrescells)
+    with StageTime.span("ExtractByAttributes"):
+        reservoir = arcpy.gp.ExtractByAttributes_sa(watershed, "VALUE <= " + str(elevpoint + maxdamheight), "resdomain") 
+
+        # Calculate the area of a reservoir in cells
+        with arcpy.da.SearchCursor(reservoir, "COUNT") as cursor:
+            cells = sum([c[0] for c in cursor]) # number of cells
+    print "RES_" + str(oid) + ": " + str(cells) + " cells"
+
+    # Measure the reservoir and the dam of a site that meets the criterion
+    if cells<minrescells:
+        return {"status": "rejected", "reason": str(cells) + " cells", "curve": curve}
+    if metricsengine=="NumPy":
+        reservoir_polygon, waterarea, slopemean, resmean, damlength, dammean, runs = gridmetrics(oid, watershed, elevpoint + maxdamheight)
+    else:
+        reservoir_polygon, waterarea, slopemean, resmean, damlength, dammean = polygonmetrics(oid, watershed, reservoir)
+        with StageTime.span("Footprint"):
+            runs = footprint(watershed, elevpoint + maxdamheight)
+
+    # Write the coordinates
+    fieldlot = []
+    fieldlot.append(("Lat", latitude))
+    fieldlot.append(("Long", longitude))
+
+    # Derive the elevation of a reservoir/dam/pour point
+    fieldlot.append(("Elevation_m", elevpoint))
+
+    # Calculate the area of a reservoir (in hectares)
+    groundarea = waterarea / math.cos(math.radians(slopemean)) if slopemean!=0 else waterarea
+    fieldlot.append(("Water_area_ha", waterarea))
+    fieldlot.append(("Ground_area_ha", groundarea))
+    
+    # Calculate the volume of a reservoir in GL
+    resvolume = waterarea * (elevpoint + maxdamheight - resmean) * pow(10, -2) # GL
+    fieldlot.append(("Reservoir_volume_GL", resvolume))
+    fieldlot.append(("Dam_length_m", damlength))
+
+    # Calculate the inside area of a dam in hectares
+    damarea = damlength * (elevpoint + maxdamheight - dammean) * pow(10, -4) / math.cos(math.atan(dambatter)) # hectares
+    fieldlot.append(("Dam_area_ha", damarea))
+
+    # Calculate the volume of a dam in GL
+    damvolume = damlength * (elevpoint + maxdamheight - dammean)**2 * pow(10, -6) * dambatter # GL
+    fieldlot.append(("Dam_volume_GL", damvolume))
+
+    # Add the half dam volume to reservoir
+    resvolume += 0.5 * damvolume
+    for i, t in enumerate(fieldlot):
+        if t[0]=="Reservoir_volume_GL":
+            fieldlot[i] = ("Reservoir_volume_GL", resvolume)
+
+    # Calculate the water/rock ratio
+    wrratio = resvolume / float(damvolume) if damvolume!=0 else 0
+    fieldlot.append(("Water_rock_ratio", wrratio))
+
+    # Get RES_1234
+    with StageTime.span("WriteReservoir"):
+        writereservoir(oid, reservoir_polygon, fieldlot)
+
+    # Record the information for each site, with the bounding box of RES_ for PrettySet
+    with StageTime.span("Describe"):
+        extent = arcpy.Describe(sitename("RES", oid)).extent
+    record = dict(fieldlot, OBJECTID=oid, XMin=extent.XMin, YMin=extent.YMin, XMax=extent.XMax, YMax=extent.YMax)
+    site = {"status": "written", "record": record, "curve": curve, "runs": runs}
+    if output=="Consolidated":
+        with StageTime.span("SiteShapes"):
+            site["shapes"] = [siteshapes(sitename(prefix, oid)) for prefix in ["RES", "DAM"]]
+    return site
+
+
+def sitename(prefix, oid):
+
+    # Feature class of the reservoir ("RES") or dam ("DAM") of a site
+    # Consolidated: scratch names overwritten by every site, as the site is appended to RESERVOIRS/DAMS
+    return prefix + "_" + str(oid) if output!="Consolidated" else prefix.lower() + "site"
+
+
+def siteshapes(fc):
+
+    # Shapes of a feature class as WKB, to be passed between processes and appended by the parent
+    with arcpy.da.SearchCursor(fc, ["SHAPE@WKB"]) as cursor:
+        return [row[0] for row in cursor]
+
+
+def restemplate(names, sr):
+
+    # Empty RES_ with the typed fields of a site and its Index, created once per workspace
+    template = os.path.join(arcpy.env.workspace, "restemplate")
+    if template not in templates:
+        arcpy.CreateFeatureclass_management(arcpy.env.workspace, "restemplate", "POLYGON", spatial_reference=sr)
+        for name in names:
+            arcpy.AddField_management(in_table=template, field_name=name, field_type="DOUBLE")
+        arcpy.AddField_management(in_table=template, field_name="Index", field_type="TEXT", field_length=16)
+        templates.add(template)
+    return template
+
+
+def writereservoir(oid, reservoir_polygon, fieldlot):
+
+    # RES_1234 from the template: the polygon(s) of the reservoir with all fields written in one insert cursor pass
+    sr = arcpy.Describe(reservoir_polygon).spatialReference
+    names = [f[0] for f in fieldlot]
+    arcpy.CreateFeatureclass_management(arcpy.env.workspace, sitename("RES", oid), "POLYGON",
+                                        template=restemplate(names, sr), spatial_reference=sr)
+    with arcpy.da.SearchCursor(reservoir_polygon, ["SHAPE@"]) as cursor:
+        shapes = [row[0] for row in cursor]
+    with arcpy.da.InsertCursor(sitename("RES", oid), ["SHAPE@"] + names + ["Index"]) as cursor:
+        for shape in shapes:
+            cursor.insertRow([shape] + [f[1] for f in fieldlot] + ["RES_" + str(oid)])
+
+
+def consolidate():
+
+    # Create RESERVOIRS and DAMS keyed by PPT_ID (indexed); when resuming, drop the rows of sites not journalled as written
+    gdb = os.path.join(directory, geodatabase)
+    done = journalread() if resume else {}
+    sr = arcpy.Describe(os.path.join(gdb, highland)).spatialReference
+    for fc, shapetype, names in [("RESERVOIRS", "POLYGON", SiteStore.sitefields), ("DAMS", "POLYLINE", [])]:
+        path = os.path.join(gdb, fc)
+        if resume and arcpy.Exists(path):
+            with arcpy.da.UpdateCursor(path, ["PPT_ID"]) as cursor:
+                for row in cursor:
+                    if row[0] not in done or done[row[0]][1]!="written":
+                        cursor.deleteRow()
+            continue
+        arcpy.CreateFeatureclass_management(gdb, fc, shapetype, spatial_reference=sr)
+        arcpy.AddField_management(in_table=path, field_name="PPT_ID", field_type="LONG")
+        for name in names:
+            arcpy.AddField_management(in_table=path, field_name=name, field_type="DOUBLE")
+        arcpy.AddField_management(in_table=path, field_name="Index", field_type="TEXT", field_length=16)
+        arcpy.AddIndex_management(in_table=path, fields="PPT_ID", index_name=fc + "_PPT_ID")
+
+
+def appendsites(written):
+
+    # Append the reservoirs and dams of written sites to RESERVOIRS and DAMS, one insert cursor each
+    gdb = os.path.join(directory, geodatabase)
+    with arcpy.da.InsertCursor(os.path.join(gdb, "RESERVOIRS"), ["SHAPE@WKB", "PPT_ID"] + SiteStore.sitefields + ["Index"]) as cursor:
+        for site in written:
+            oid = site["record"]["OBJECTID"]
+            for shape in site["shapes"][0]:
+                cursor.insertRow([shape, oid] + [site["record"][f] for f in SiteStore.sitefields] + ["RES_" + str(oid)])
+    with arcpy.da.InsertCursor(os.path.join(gdb, "DAMS"), ["SHAPE@WKB", "PPT_ID", "Index"]) as cursor:
+        for site in written:
+            oid = site["record"]["OBJECTID"]
+            for shape in site["shapes"][1]:
+                cursor.insertRow([shape, oid, "DAM_" + str(oid)])
+
+
+def recordcurve(oid, curve):
+
+    # Record the reservoir of each dam height
+    with open(os.path.join(directory, "damheights.csv"), "a") as csvfile:
+        writer = csv.writer(csvfile)
+        for i in range(len(curve["Dam_height_m"])):
+            writer.writerow(["RES_" + str(oid)] + [curve[f][i] for f in ["Dam_height_m", "Cells", "Water_area_ha", "Reservoir_volume_GL", "Passed"]])
+
+
+def journalread():
+
+    # Last outcome of each pour point in the journal: {OBJECTID: [OBJECTID, status, detail, footprint, checksum]}
+    # A row cut off by a crash fails its checksum and is not done
+    journal = {}
+    try:
+        with open(os.path.join(directory, "journal.csv"), "r") as csvfile:
+            for row in csv.reader(csvfile):
+                if len(row)==5 and row[4]==journalchecksum(row[:4]):
+                    journal[int(row[0])] = row
+    except IOError:
+        pass
+    return journal
+
+
+def journalchecksum(fields):
+
+    # End-of-record checksum of a journal row: CRC-32 of its fields
+    return "%08x" % (zlib.crc32(",".join(fields)) & 0xffffffff)
+
+
+def journalwrite(journal, entries):
+
+    # Append the outcomes of pour points [(OBJECTID, status, detail, footprint runs)], each row closed by its checksum,
+    # and force them to disk
+    writer = csv.writer(journal)
+    for oid, status, detail, runs in entries:
+        fields = [str(oid), status, detail, " ".join(str(i) for i in runs.ravel()) if runs is not None else ""]
+        writer.writerow(fields + [journalchecksum(fields)])
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def journalfootprints():
+
+    # Footprints of all written sites in the journal, including those of earlier (interrupted) runs
+    footprints = {}
+    for oid, row in journalread().items():
+        if row[1]=="written" and row[3]:
+            footprints[oid] = numpy.array(row[3].split(), dtype=numpy.int64).reshape(-1, 2)
+    return footprints
+
+
+def screenrecord(oid, site, error=None, scratch=None):
+
+    # Record the outcome of a pour point: curve and RES_/DAM_ (copied from a worker's scratch geodatabase)
+    # Return its journal entry and the site (None unless written)
+    if error is not None:
+        return (oid, "errored", error.strip().split("\n")[-1], None), None
+    if site.get("curve") is not None:
+        recordcurve(oid, site["curve"])
+    if site["status"]!="written":
+        return (oid, site["status"], site.get("reason", ""), None), None
+    if scratch is not None and output!="Consolidated":
+        for fc in ["RES_" + str(oid), "DAM_" + str(oid)]:
+            arcpy.Copy_management(os.path.join(scratch, fc), os.path.join(directory, geodatabase, fc))
+    return (oid, site["status"], "", site.get("runs")), site
+
+
+def screenflush(journal, conn, outcomes):
+
+    # Write a batch of outcomes: RESERVOIRS/DAMS, the records in one store transaction, then the journal entries with one fsync
+    # The journal comes last, so a site in the journal is complete; a site stored but not journalled is screened again
+    with StageTime.span("Flush"):
+        written = [site for entry, site in outcomes if site is not None]
+        if output=="Consolidated" and written:
+            appendsites(written)
+        SiteStore.insert(conn, [site["record"] for site in written])
+        journalwrite(journal, [entry for entry, record in outcomes])
+    StageTime.write(os.path.join(directory, "trace.jsonl"), StageTime.drain())
+    del outcomes[:]
+
+
+def screenstatus(site, error):
+
+    # Status of a screened pour point in the trace
+    if error is not None:
+        return "errored"
+    return "accepted" if site["status"]=="written" else "rejected"
+
+
+def screenlist():
+
+    # Pour points to screen, in OBJECTID order: all or the given range, less those already done when resuming
+    # Errored pour points in the journal are retried
+    screenset = None if screenrange=="All" else set(screenrange)
+    done = journalread() if resume else {}
+    with arcpy.da.SearchCursor(points, "OBJECTID") as cursor:
+        oids = sorted([idx[0] for idx in cursor if screenset is None or idx[0] in screenset])
+    todo = [oid for oid in oids if oid not in done or done[oid][1]=="errored"]
+    if resume:
+        print "Resume: " + str(len(oids) - len(todo)) + " pour points already done, " + str(len(todo)) + " to screen"
+    return todo
+
+
+def screenorder(oids):
+
+    # Order the pour points along a Hilbert curve, so that consecutive points (and the points of a batch) are neighbours
+    screenset = set(oids)
+    with arcpy.da.SearchCursor(points, ["OBJECTID", "POINT_X", "POINT_Y"]) as cursor:
+        rows = [row for row in cursor if row[0] in screenset]
+    if not rows:
+        return []
+    ids, xs, ys = zip(*rows)
+    return [ids[i] for i in GullyArray.hilbertorder(xs, ys)]
+
+
+def screen(batchsize=50):
 
     # Number of pour points
     arcpy.env.extent = points
     print "Number of pour points: " + str(int(arcpy.GetCount_management(points).getOutput(0)))
 
+    # Label all watersheds at once
+    if watershedengine=="NumPy":
+        prepwatersheds()
+
+    # One output dataset each for reservoirs and dams
+    if output=="Consolidated":
+        consolidate()
+
+    # Pour points to screen, less those whose watershed is too small
+    oids = screenlist()
+    if prefilter:
+        oids = prefilterpoints(oids)
+    if schedule=="Hilbert":
+        oids = screenorder(oids)
+
+    # Screen on a pool of processes
+    if processes>1:
+        screenparallel(oids)
+        return
+
     # Initialise an error list
     errorl = []
 
-    # Calculation on each of the pour points
-    with arcpy.da.SearchCursor(points, "OBJECTID") as cursor:
-        for idx in cursor:
+    # Calculation on each of the pour points, written every batchsize pour points
+    conn = SiteStore.connect(os.path.join(directory, store))
+    outcomes = []
+    with open(os.path.join(directory, "journal.csv"), "a") as journal:
+        for oid in oids:
+            site, error = None, None
+            StageTime.begin(oid)
             try:
-                # Calculate All the points or just a given range
-                if screenrange=="All":
-                    pass
-                else:
-                    if idx[0] not in screenrange:
-                        continue
-
-                # Select a pour point from the layer
-                arcpy.env.extent = points # Recover the Processing Extent
-                lyrpp = arcpy.MakeFeatureLayer_management(in_features=points, out_layer="pptlayer",
-                                                          where_clause="OBJECTID = " + str(idx[0])) # a layer of a pour point
-                point = arcpy.CopyFeatures_management(in_features=lyrpp, out_feature_class=os.path.join("in_memory", "appt" + str(idx[0])))
-
-                # Get the coordinates
-                cursor = arcpy.SearchCursor(point)
-                row = cursor.next()
-                latitude = row.getValue("POINT_Y")
-                longitude = row.getValue("POINT_X")
-
-                # Reduce the Processing Extent
-                arcpy.env.extent = arcpy.Extent(longitude-0.05, latitude+0.05, longitude+0.05, latitude-0.05)
-
-                # Calculate watershed and reservoir
-                watershed = arcpy.gp.Watershed_sa(direction, point, "wshed", "OBJECTID") # Define a watershed
-                watershed = arcpy.gp.ExtractByMask_sa(highland, watershed) # Get the DEM of a watershed
-                watershed = arcpy.Raster(watershed)
-                elevpoint = watershed.minimum
-                if elevpoint==None:
-                    print "Watershed of Point " + str(idx[0]) + " is None (ignored)."
-                    continue
-                reservoir = arcpy.gp.ExtractByAttributes_sa(watershed, "VALUE <= " + str(elevpoint + maxdamheight), "resdomain") 
-
-                # Calculate the area of a reservoir in cells
-                with arcpy.da.SearchCursor(reservoir, "COUNT") as cursor:
-                    cells = sum([c[0] for c in cursor]) # number of cells
-                print "RES_" + str(idx[0]) + ": " + str(cells) + " cells"
-
-                # Output a polygon that meets the criterion
-                if cells<minrescells:
-                    continue
-                else:
-                    watershed_polygon = arcpy.RasterToPolygon_conversion(in_raster=watershed * 0,
-                                                                         out_polygon_features="wshedpolygon",
-                                                                         simplify="NO_SIMPLIFY")
-                    reservoir = arcpy.Raster(reservoir)
-                    reservoir_polygon = arcpy.RasterToPolygon_conversion(in_raster=reservoir * 0,
-                                                                         out_polygon_features="respolygon",
-                                                                         simplify="NO_SIMPLIFY")
-                   
-                # If there is an isolated tiny polygon?
-                rescount = int(arcpy.GetCount_management(reservoir_polygon).getOutput(0))
-                if rescount>1:
-                    with arcpy.da.SearchCursor(reservoir_polygon, "SHAPE_AREA") as cursor:
-                        maxresarea = max([a[0] for a in cursor])
-                    lyrres = arcpy.MakeFeatureLayer_management(in_features=reservoir_polygon, out_layer="areslayer",
-                                                               where_clause="SHAPE_AREA = " + str(maxresarea)) # a layer of a polygon
-                    reservoir_polygon = arcpy.CopyFeatures_management(in_features=lyrres, out_feature_class="respolygon1")
-                assert int(arcpy.GetCount_management(reservoir_polygon).getOutput(0))==1
-
-                # Write the coordinates
-                coordinates = str(latitude) + "   " + str(longitude)
-                fieldlot = []
-                fieldlot.append(("Lat", latitude))
-                fieldlot.append(("Long", longitude))
-
-                # Derive the elevation of a reservoir/dam/pour point
-                elevation = elevpoint
-                fieldlot.append(("Elevation_m", elevpoint))
-
-                # Calculate the average slope of a reservoir
-                resslope = arcpy.gp.ExtractByMask_sa(landslope, reservoir_polygon, "resslp") # Get the DEM of a watershed
-                resslope = arcpy.Raster(resslope)
-
-                # Project to GDA 1994 Geoscience Australia Lambert: 3112
-                # GCS_WGS_1984: 4326
-                reservoir_polygongda94 = arcpy.Project_management(in_dataset=reservoir_polygon,
-                                                                  out_dataset="respolygongda94",
-                                                                  out_coor_system=arcpy.SpatialReference(3112),
-                                                                  transform_method="GDA_1994_To_WGS_1984",
-                                                                  in_coor_system=arcpy.SpatialReference(4326))
-                
-                # Calculate the area of a reservoir (in hectares)
-                with arcpy.da.SearchCursor(reservoir_polygongda94, "SHAPE_AREA") as cursor:
-                    waterarea = cursor.next()[0] * pow(10, -4) # hectares
-                groundarea = waterarea / math.cos(math.radians(resslope.mean)) if resslope.mean!=0 else waterarea
-                fieldlot.append(("Water_area_ha", waterarea))
-                fieldlot.append(("Ground_area_ha", groundarea))
-                
-                # Calculate the volume of a reservoir in GL
-                resvolume = waterarea * (elevpoint + maxdamheight - reservoir.mean) * pow(10, -2) # GL
-                fieldlot.append(("Reservoir_volume_GL", resvolume))
-
-                # Build a dam
-                dam_polyline = arcpy.Intersect_analysis(in_features=[watershed_polygon, reservoir_polygon],
-                                                        out_feature_class="DAM_" + str(idx[0]),
-                                                        output_type="LINE")
-
-                # Project to GDA 1994 Geoscience Australia Lambert: 3112
-                # GCS_WGS_1984: 4326
-                dam_polylinegda94 = arcpy.Project_management(in_dataset=dam_polyline,
-                                                             out_dataset="dampolylinegda94",
-                                                             out_coor_system=arcpy.SpatialReference(3112),
-                                                             transform_method="GDA_1994_To_WGS_1984",
-                                                             in_coor_system=arcpy.SpatialReference(4326))
-
-                # Calculate the length of a dam in metres
-                with arcpy.da.SearchCursor(dam_polylinegda94, "SHAPE_LENGTH") as cursor:
-                    damlength = cursor.next()[0] # metres
-                fieldlot.append(("Dam_length_m", damlength))
-
-                # Get the DEM of a dam
-                dam = arcpy.gp.ExtractByMask_sa(highland, dam_polyline, "damdem")
-                dam = arcpy.Raster(dam)
-
-                # Calculate the inside area of a dam in hectares
-                damarea = damlength * (elevpoint + maxdamheight - dam.mean) * pow(10, -4) / math.cos(math.atan(dambatter)) # hectares
-                fieldlot.append(("Dam_area_ha", damarea))
-
-                # Calculate the volume of a dam in GL
-                damvolume = damlength * (elevpoint + maxdamheight - dam.mean)**2 * pow(10, -6) * dambatter # GL
-                fieldlot.append(("Dam_volume_GL", damvolume))
-
-                # Add the half dam volume to reservoir
-                resvolume += 0.5 * damvolume
-                for i, t in enumerate(fieldlot):
-                    if t[0]=="Reservoir_volume_GL":
-                        fieldlot[i] = ("Reservoir_volume_GL", resvolume)
-
-                # Calculate the water/rock ratio
-                wrratio = resvolume / float(damvolume) if damvolume!=0 else 0
-                fieldlot.append(("Water_rock_ratio", wrratio))
-
-                # Add Field
-                for f in fieldlot:
-                    arcpy.AddField_management(in_table=reservoir_polygon, field_name=f[0], field_type="TEXT")
-                    arcpy.CalculateField_management(in_table=reservoir_polygon, field=f[0], expression=str(f[1]), expression_type="PYTHON")
-
-                # Get RES_1234
-                arcpy.CopyFeatures_management(in_features=reservoir_polygon, out_feature_class="RES_" + str(idx[0]))
+                site = screenpoint(oid)
 
             # Escape from any unexpected interruption
             except arcpy.ExecuteError as err:
-                errorl.append(idx[0])
-                print "Occurs at: " + str(dt.datetime.now())
-                print "ArcPy ExecuteError: {0}".format(err)
-                continue
+                error = "ArcPy ExecuteError: {0}".format(err)
             except RuntimeError:
-                errorl.append(idx[0])
-                print "Occurs at: " + str(dt.datetime.now())
-                print traceback.format_exc(sys.exc_info())
-                continue
+                error = traceback.format_exc(sys.exc_info())
             except AssertionError:
                 print traceback.format_exc(sys.exc_info())
-                continue                
+                site = {"status": "rejected", "reason": "AssertionError"}
+            if error is not None:
+                errorl.append(oid)
+                print "Occurs at: " + str(dt.datetime.now())
+                print error
+            StageTime.end(screenstatus(site, error))
 
             # Record the information for each site
-            with open(os.path.join(directory, "records.csv"), "a") as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(("RES_" + str(idx[0]), coordinates, elevation, waterarea, groundarea, resvolume, damlength, damarea, damvolume, wrratio))
+            with StageTime.span("Record"):
+                outcomes.append(screenrecord(oid, site if error is None else None, error))
+            if len(outcomes)>=batchsize:
+                screenflush(journal, conn, outcomes)
+        screenflush(journal, conn, outcomes)
+    conn.close()
+    if tiles is not None:
+        print "Tile cache: " + str(tiles["hits"]) + " hits, " + str(tiles["misses"]) + " tiles read"
+
+    screensave()
+    print errorl
+
+
+def screensave():
+
+    # Footprints of all written sites for PrettySet, and the store as records.csv (with a header)
+    grid = highlandgrid()
+    SetArray.savefootprints(os.path.join(directory, "footprints.npz"), journalfootprints(),
+                            [grid["left"], grid["top"], grid["cellsize"], grid["area"].size, grid["cols"]])
+    SiteStore.exportcsv(os.path.join(directory, store), os.path.join(directory, "records.csv"))
+
+    # Where the time went
+    if tracing and os.path.exists(os.path.join(directory, "trace.jsonl")):
+        print StageTime.table(os.path.join(directory, "trace.jsonl"), os.path.join(directory, "trace_summary.csv"))
+
+
+def screenworker(scratch):
+
+    # Initialise a worker process: its own scratch geodatabase as workspace, so "wshed", "resdomain", etc. never clash
+    global highland, direction, points, landslope, shed
+    gdb = "Scratch_" + str(os.getpid()) + ".gdb"
+    if not arcpy.Exists(os.path.join(scratch, gdb)):
+        arcpy.CreateFileGDB_management(scratch, gdb)
+    highland, direction, points, landslope = [os.path.join(directory, geodatabase, ds) for ds in [highland, direction, points, landslope]]
+    arcpy.env.workspace = os.path.join(scratch, gdb)
+    arcpy.CheckOutExtension("Spatial")
+    if watershedengine=="NumPy":
+        shed = GullyArray.loadwatersheds(os.path.join(directory, "watersheds"))
+
+
+def screentask(oids):
+
+    # Screen a batch of pour points in a worker: [(OBJECTID, outcome, error, scratch geodatabase)] and its trace events
+    results = []
+    for oid in oids:
+        site, error = None, None
+        StageTime.begin(oid)
+        try:
+            site = screenpoint(oid)
+        except arcpy.ExecuteError as err:
+            error = "ArcPy ExecuteError: {0}".format(err)
+        except RuntimeError:
+            error = traceback.format_exc(sys.exc_info())
+        except AssertionError:
+            print traceback.format_exc(sys.exc_info())
+            site = {"status": "rejected", "reason": "AssertionError"}
+        if error is not None:
+            print "Occurs at: " + str(dt.datetime.now())
+            print error
+        StageTime.end(screenstatus(site, error))
+        results.append((oid, site, error, arcpy.env.workspace))
+    return results, StageTime.drain()
+
+
+def screenparallel(oids, batchsize=50):
+
+    # Screen the batches on a pool of processes
+    # Batches come back in submission order and are recorded and journalled as soon as they arrive
+    batches = [oids[i:i + batchsize] for i in range(0, len(oids), batchsize)]
+    errorl = []
+    pool = multiprocessing.Pool(processes, initializer=screenworker, initargs=(directory,))
+    conn = SiteStore.connect(os.path.join(directory, store))
+    with open(os.path.join(directory, "journal.csv"), "a") as journal:
+        for i, (batch, events) in enumerate(pool.imap(screentask, batches)):
+
+            # Merge RES_/DAM_, records, curves, footprints, errors and trace in screening order, one store transaction per batch
+            StageTime.merge(events)
+            outcomes = []
+            for oid, site, error, scratch in batch:
+                if error is not None:
+                    errorl.append(oid)
+                with StageTime.span("Record"):
+                    outcomes.append(screenrecord(oid, site, error, scratch))
+            screenflush(journal, conn, outcomes)
+            print "Batch " + str(i + 1) + "/" + str(len(batches)) + " finished at " + str(dt.datetime.now())
+    conn.close()
+    pool.close()
+    pool.join()
 
-    print errorl                
+    screensave()
+    print errorl
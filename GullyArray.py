@@ -0,0 +1,490 @@
+# NumPy engines of DryGully.screen ("NumPy" watershed and metrics engines - Interface Check 12, 14).
+# Watersheds of all pour points are labelled in one pass over the flow-direction grid and nested as a parent/child tree;
+# label elevations are memoized, reservoirs read off hypsometric curves and measured on the grid with geodesic areas.
+# Pour points can be scheduled along a Hilbert curve over a tiled cache of the input rasters.
+# Bug reports to: bin.lu@anu.edu.au
+
+import collections
+import numpy as np
+
+# ESRI D8 codes and their (row, column) steps; rows increase southwards
+d8 = {1: (0, 1), 2: (1, 1), 4: (1, 0), 8: (1, -1), 16: (0, -1), 32: (-1, -1), 64: (-1, 0), 128: (-1, 1)}
+
+
+def receivers(direction):
+
+    # Flat index of the downstream cell of every cell; -1 for sinks, NoData and flow off the grid
+    rows, cols = direction.shape
+    flat = np.asarray(direction).ravel()
+    recv = np.full(flat.size, -1, dtype=np.int64)
+    for code, step in d8.items():
+        cells = np.nonzero(flat==code)[0]
+        row = cells // cols + step[0]
+        col = cells % cols + step[1]
+        inside = (row>=0) & (row<rows) & (col>=0) & (col<cols)
+        recv[cells[inside]] = row[inside] * cols + col[inside]
+    return recv
+
+
+def flowlevels(recv):
+
+    # Topological levels of the flow graph, from cells without donors down to the outlets
+    # Every cell is visited once; cells on flow loops (if any) are left out
+    indegree = np.bincount(recv[recv>=0], minlength=recv.size).astype(np.int32)
+    frontier = np.nonzero(indegree==0)[0]
+    levels = []
+    while frontier.size:
+        levels.append(frontier)
+        down = recv[frontier]
+        down, counts = np.unique(down[down>=0], return_counts=True)
+        indegree[down] -= counts
+        frontier = down[indegree[down]==0]
+    return levels
+
+
+def accumulation(recv, levels):
+
+    # Number of upstream cells of every cell (the cell itself excluded, as FlowAccumulation)
+    # Donors come in earlier levels, so the count of a cell is complete before it is passed downstream
+    acc = np.zeros(recv.size, dtype=np.int64)
+    for level in levels:
+        down = recv[level]
+        inside = down>=0
+        np.add.at(acc, down[inside], acc[level[inside]] + 1)
+    return acc
+
+
+def pourcells(xs, ys, transform, shape):
+
+    # Flat cell index of pour points from their coordinates; transform = (left, top, cell size)
+    left, top, cellsize = transform
+    row = np.floor((top - np.asarray(ys, dtype=np.float64)) / cellsize).astype(np.int64)
+    col = np.floor((np.asarray(xs, dtype=np.float64) - left) / cellsize).astype(np.int64)
+    assert ((row>=0) & (row<shape[0]) & (col>=0) & (col<shape[1])).all(), "Pour points outside the flow-direction grid."
+    return row * shape[1] + col
+
+
+def watersheds(direction, cells, ids):
+
+    # Label the watershed of every pour point at once
+    # Returns the labels (nearest downstream pour point id, 0 for none) and {id: id of the pour point right downstream, or 0}
+    recv = receivers(direction)
+    levels = flowlevels(recv)
+    cells = np.asarray(cells, dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.int32)
+    own = np.zeros(recv.size, dtype=np.int32)
+    own[cells] = ids
+    labels = own.copy()
+
+    # From the outlets upwards, a cell without a pour point inherits the label of its downstream cell
+    for level in reversed(levels):
+        down = recv[level]
+        inherit = (own[level]==0) & (down>=0)
+        labels[level[inherit]] = labels[down[inherit]]
+
+    # The parent of a pour point is the label right below its cell
+    down = recv[cells]
+    parents = np.where(down>=0, labels[np.maximum(down, 0)], 0)
+    return labels.reshape(direction.shape), dict(zip(ids.tolist(), parents.tolist()))
+
+
+def watershedindex(labels, parents, transform):
+
+    # Group the labelled cells by pour point: cells of label k are order[start[k]:start[k + 1]] (sorted)
+    flat = labels.ravel()
+    order = np.nonzero(flat)[0]
+    order = order[np.argsort(flat[order], kind="mergesort")]
+    counts = np.bincount(flat[order], minlength=max(parents) + 1 if parents else 1)
+    start = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    children = {}
+    for child, parent in parents.items():
+        if parent!=0:
+            children.setdefault(parent, []).append(child)
+    return {"order": order, "start": start, "children": children, "parents": parents,
+            "shape": labels.shape, "transform": transform, "windows": labelwindows(order, start, labels.shape[1])}
+
+
+def labelwindows(order, start, cols):
+
+    # Window (row0, row1, col0, col1) of the cells of each label, (0, 0, 0, 0) for an empty label
+    windows = np.zeros((start.size - 1, 4), dtype=np.int64)
+    full = np.nonzero(np.diff(start))[0]
+    if full.size:
+        rows, columns = np.asarray(order) // cols, np.asarray(order) % cols
+        windows[full, 0] = np.minimum.reduceat(rows, start[full])
+        windows[full, 1] = np.maximum.reduceat(rows, start[full]) + 1
+        windows[full, 2] = np.minimum.reduceat(columns, start[full])
+        windows[full, 3] = np.maximum.reduceat(columns, start[full]) + 1
+    return windows
+
+
+def upstream(shed, pid):
+
+    # Pour point pid and every pour point nested upstream of it
+    stack, nested = [pid], []
+    while stack:
+        p = stack.pop()
+        nested.append(p)
+        stack.extend(shed["children"].get(p, []))
+    return nested
+
+
+def upstreamcounts(shed):
+
+    # Number of cells in the watershed of every pour point, nested watersheds included, added up from the sources down:
+    # {id: cells}, 0 for a pour point whose cell another point took
+    start, children = shed["start"], shed["children"]
+    own = lambda p: int(start[p + 1] - start[p]) if p + 1<start.size else 0
+    order = [p for p, parent in shed["parents"].items() if parent==0]
+    k = 0
+    while k<len(order):
+        order.extend(children.get(order[k], []))
+        k += 1
+    counts = {}
+    for p in reversed(order):
+        counts[p] = own(p) + sum(counts[c] for c in children.get(p, []))
+    return dict((p, counts[p] if own(p) else 0) for p in counts)
+
+
+def watershedcells(shed, pid, box=None):
+
+    # Sorted flat cell indices of the watershed of pour point pid, nested watersheds included
+    # Within a cell window box = (row0, row1, col0, col1): labels outside it are skipped, labels across it are cut
+    order, start, windows, cols = shed["order"], shed["start"], shed["windows"], shed["shape"][1]
+    cells = []
+    for p in upstream(shed, pid):
+        if p + 1>=start.size or start[p]==start[p + 1]:
+            continue
+        piece = np.asarray(order[start[p]:start[p + 1]])
+        if box is not None:
+            window = windows[p]
+            if window[1]<=box[0] or window[0]>=box[1] or window[3]<=box[2] or window[2]>=box[3]:
+                continue
+            if window[0]<box[0] or window[1]>box[1] or window[2]<box[2] or window[3]>box[3]:
+                rows, columns = piece // cols, piece % cols
+                piece = piece[(rows>=box[0]) & (rows<box[1]) & (columns>=box[2]) & (columns<box[3])]
+        cells.append(piece)
+    return np.sort(np.concatenate(cells)) if cells else np.zeros(0, dtype=np.int64)
+
+
+def watershedmemo(shed, read, maxcells):
+
+    # Memo of the labels of a watershed index: read(row0, row1, col0, col1) returns the elevations of a window of the
+    # flow-direction grid (NaN for NoData); the least recently used labels are dropped beyond maxcells cells
+    return {"shed": shed, "read": read, "max": maxcells, "cells": 0, "labels": collections.OrderedDict()}
+
+
+def labelelevations(memo, label):
+
+    # Rows, columns and elevations of the cells of a label (the own part of a watershed), sorted by elevation,
+    # and the window of the label
+    labels = memo["labels"]
+    piece = labels.pop(label, None)
+    if piece is None:
+        shed = memo["shed"]
+        order, start = shed["order"], shed["start"]
+        cells = np.asarray(order[start[label]:start[label + 1]]) if label + 1<start.size else np.zeros(0, dtype=np.int64)
+        if cells.size:
+            window = tuple(int(w) for w in shed["windows"][label])
+            rows, cols = cells // shed["shape"][1], cells % shed["shape"][1]
+            elev = memo["read"](*window)[rows - window[0], cols - window[2]]
+            keep = np.nonzero(~np.isnan(elev))[0]
+            keep = keep[np.argsort(elev[keep], kind="mergesort")]
+            piece = (rows[keep].astype(np.int32), cols[keep].astype(np.int32), elev[keep].astype(np.float32), window)
+        else:
+            piece = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32), (0, 0, 0, 0))
+        while labels and memo["cells"] + piece[2].size>memo["max"]:
+            memo["cells"] -= labels.popitem(last=False)[1][2].size
+        memo["cells"] += piece[2].size
+    labels[label] = piece
+    return piece
+
+
+def clippedelevations(memo, label, box):
+
+    # Sorted elevations of the cells of a label within the cell window box, read from the window of those cells only
+    # and not memoized, so a label across the box never costs more than the box
+    shed = memo["shed"]
+    order, start, cols = shed["order"], shed["start"], shed["shape"][1]
+    cells = np.asarray(order[start[label]:start[label + 1]])
+    rows, columns = cells // cols, cells % cols
+    inside = (rows>=box[0]) & (rows<box[1]) & (columns>=box[2]) & (columns<box[3])
+    if not inside.any():
+        return np.zeros(0, dtype=np.float32)
+    window = cellwindow(shed, cells[inside])[0]
+    elev = memo["read"](*window)[rows[inside] - window[0], columns[inside] - window[2]]
+    return np.sort(elev[~np.isnan(elev)]).astype(np.float32)
+
+
+def nestedelevations(memo, pid, box):
+
+    # Sorted elevations of the watershed of pour point pid within the cell window box = (row0, row1, col0, col1),
+    # one array per nested label: labels inside the box are taken whole from the memo, labels across it are cut,
+    # labels outside it are never read
+    row0, row1, col0, col1 = box
+    shed = memo["shed"]
+    pieces = []
+    for label in upstream(shed, pid):
+        if label + 1>=shed["start"].size or shed["start"][label]==shed["start"][label + 1]:
+            continue
+        window = shed["windows"][label]
+        if window[1]<=row0 or window[0]>=row1 or window[3]<=col0 or window[2]>=col1:
+            continue
+        if window[0]<row0 or window[1]>row1 or window[2]<col0 or window[3]>col1:
+            elev = clippedelevations(memo, label, box)
+        else:
+            elev = labelelevations(memo, label)[2]
+        if elev.size:
+            pieces.append(elev.astype(np.float64))
+    return pieces
+
+
+def cellwindow(shed, cells):
+
+    # Bounding window (row0, row1, col0, col1) of a set of cells and a boolean mask of them within it
+    rows, cols = cells // shed["shape"][1], cells % shed["shape"][1] # No np.divmod before NumPy 1.13 (ArcGIS Desktop)
+    window = (rows.min(), rows.max() + 1, cols.min(), cols.max() + 1)
+    mask = np.zeros((window[1] - window[0], window[3] - window[2]), dtype=np.bool_)
+    mask[rows - window[0], cols - window[2]] = True
+    return window, mask
+
+
+def savewatersheds(prefix, shed):
+
+    # Save the watershed index: the cell order as a memory-mappable .npy, the rest in a small .npz
+    np.save(prefix + "_order.npy", shed["order"])
+    parents = np.array(sorted(shed["parents"].items()), dtype=np.int64).reshape(-1, 2)
+    np.savez(prefix + ".npz", start=shed["start"], parents=parents, shape=np.array(shed["shape"]),
+             transform=np.array(shed["transform"], dtype=np.float64), windows=shed["windows"])
+
+
+def loadwatersheds(prefix):
+
+    # Open a saved watershed index, with the cell order memory-mapped
+    with np.load(prefix + ".npz") as saved:
+        parents = dict((int(c), int(p)) for c, p in saved["parents"])
+        children = {}
+        for child, parent in parents.items():
+            if parent!=0:
+                children.setdefault(parent, []).append(child)
+        order = np.load(prefix + "_order.npy", mmap_mode="r")
+        windows = saved["windows"] if "windows" in saved.files else labelwindows(order, saved["start"], int(saved["shape"][1]))
+        return {"order": order, "start": saved["start"], "children": children, "parents": parents,
+                "shape": tuple(saved["shape"]), "transform": tuple(saved["transform"]), "windows": windows}
+
+
+def cellarea(lat0, lat1, width):
+
+    # Area (m2) of cells between latitudes lat0 and lat1 and width degrees of longitude on the WGS84 ellipsoid
+    a, f = 6378137.0, 1 / 298.257223563
+    e = np.sqrt(f * (2 - f))
+    b2 = (a * (1 - f))**2
+    def q(lat):
+        s = np.sin(np.radians(lat))
+        return s / (1 - (e * s)**2) + np.log((1 + e * s) / (1 - e * s)) / (2 * e)
+    return np.abs(np.radians(width) * b2 / 2 * (q(lat1) - q(lat0)))
+
+
+def hypsometry(elev):
+
+    # Hypsometric curve of a watershed: its cell elevations sorted (NoData as NaN dropped) and their running sums
+    elev = np.asarray(elev, dtype=np.float64).ravel()
+    elev = np.sort(elev[~np.isnan(elev)])
+    return elev, np.concatenate([[0.0], np.cumsum(elev)])
+
+
+def reservoircurve(curve, damheights, area, minrescells):
+
+    # Reservoirs of several dam heights read off a hypsometric curve, as screen() does for maxdamheight:
+    # cells at or below the pour point + dam height, water area (ha) and volume (GL) with area (m2) per cell
+    elev, cumsum = curve
+    heights = np.asarray(damheights, dtype=np.float64)
+    levels = elev[0] + heights if elev.size else heights * np.nan
+    cells = np.searchsorted(elev, levels, side="right")
+    meanelev = cumsum[cells] / np.maximum(cells, 1)
+    waterarea = cells * area * pow(10, -4) # hectares
+    resvolume = waterarea * (levels - meanelev) * pow(10, -2) # GL
+    return {"Dam_height_m": heights, "Cells": cells, "Water_area_ha": waterarea, "Reservoir_volume_GL": resvolume,
+            "Passed": cells>=minrescells}
+
+
+def rowgeometry(top, cellsize, rows):
+
+    # Geodesic lookup by latitude row on the WGS84 ellipsoid: cell area (m2) and cell height (m) of each row,
+    # width (m) of each of the rows + 1 horizontal cell edges (edge i is the top of row i)
+    a, f = 6378137.0, 1 / 298.257223563
+    e2 = f * (2 - f)
+    edges = top - cellsize * np.arange(rows + 1)
+    middle = np.radians((edges[:-1] + edges[1:]) / 2)
+    height = a * (1 - e2) / (1 - e2 * np.sin(middle)**2)**1.5 * np.radians(cellsize)
+    width = a * np.cos(np.radians(edges)) / np.sqrt(1 - e2 * np.sin(np.radians(edges))**2) * np.radians(cellsize)
+    return {"top": top, "cellsize": cellsize, "area": cellarea(edges[1:], edges[:-1], cellsize), "height": height, "width": width}
+
+
+def components(mask):
+
+    # 4-connected components of a boolean mask (as RasterToPolygon separates them): labels (0 outside) and their number
+    # Runs of each row are joined to the overlapping runs of the row above with a union-find
+    edges = np.diff(np.pad(mask.astype(np.int8), ((0, 0), (1, 1)), mode="constant"), axis=1)
+    rows, starts = np.nonzero(edges==1)
+    ends = np.nonzero(edges==-1)[1]
+    parent = list(range(rows.size))
+    def find(i):
+        while parent[i]!=i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    bounds = np.searchsorted(rows, np.arange(mask.shape[0] + 1))
+    for row in range(1, mask.shape[0]):
+        i, j = bounds[row - 1], bounds[row]
+        while i<bounds[row] and j<bounds[row + 1]:
+            if starts[i]<ends[j] and starts[j]<ends[i]:
+                a, b = find(i), find(j)
+                if a!=b:
+                    parent[max(a, b)] = min(a, b)
+            if ends[i]<ends[j]:
+                i += 1
+            else:
+                j += 1
+    roots = np.array([find(i) for i in range(rows.size)], dtype=np.int64)
+    number, runlabels = np.unique(roots, return_inverse=True)
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    for row, start, end, label in zip(rows, starts, ends, runlabels):
+        labels[row, start:end] = label + 1
+    return labels, number.size
+
+
+def largestreservoir(elev, level, area):
+
+    # Cells at or below level (the reservoir raster) and the largest of its polygons by area; area (m2) per row
+    with np.errstate(invalid="ignore"):
+        water = elev<=level
+    labels, number = components(water)
+    if number==0:
+        return water, None, 0.0
+    sizes = np.bincount(labels.ravel(), weights=np.repeat(area, elev.shape[1]), minlength=number + 1)
+    return water, labels==np.argmax(sizes[1:]) + 1, float(sizes[1:].max())
+
+
+def sitemetrics(elev, level, slope, dem, geometry, row0):
+
+    # Reservoir and dam of a watershed window on the grid, as screen() derives them from polygons:
+    # elev is the watershed DEM (NaN outside), slope/dem the slope and DEM of the same window, row0 its first row in geometry
+    rows = elev.shape[0]
+
+    # Keep the largest reservoir polygon
+    water, keep, waterarea = largestreservoir(elev, level, geometry["area"][row0:row0 + rows])
+    if keep is None:
+        return None
+
+    # Dam edges: reservoir cell edges shared with the boundary of the watershed (or of the window)
+    inside = np.pad(~np.isnan(elev), 1, mode="constant")
+    segments, lengths = [], []
+    damcells = np.zeros((rows + 2, elev.shape[1] + 2), dtype=np.bool_)
+    for step, edge in [((-1, 0), (0, 0, 0, 1)), ((1, 0), (1, 0, 1, 1)), ((0, -1), (0, 0, 1, 0)), ((0, 1), (0, 1, 1, 1))]:
+        outside = ~inside[1 + step[0]:1 + step[0] + rows, 1 + step[1]:1 + step[1] + elev.shape[1]]
+        r, c = np.nonzero(keep & outside)
+        segments.append(np.column_stack([r + edge[0], c + edge[1], r + edge[2], c + edge[3]]))
+        lengths.append(geometry["width"][row0 + r + edge[0]] if step[1]==0 else geometry["height"][row0 + r])
+        damcells[1 + r, 1 + c] = True
+        damcells[1 + r + step[0], 1 + c + step[1]] = True
+
+    # The dam DEM is taken from the cells on both sides of the dam line
+    segments = np.concatenate(segments)
+    damcells = damcells[1:-1, 1:-1]
+
+    return {"reservoir": keep,
+            "cells": int(water.sum()),
+            "waterarea": waterarea,
+            "resmean": float(np.nanmean(elev[water])),
+            "slopemean": float(np.nanmean(slope[keep])) if np.isfinite(slope[keep]).any() else 0.0,
+            "damlength": float(np.concatenate(lengths).sum()),
+            "dammean": float(np.nanmean(dem[damcells])) if np.isfinite(dem[damcells]).any() else np.nan,
+            "segments": segments}
+
+
+def segmentpaths(segments):
+
+    # Join cell edges [row0, col0, row1, col1] into paths of corners (row, col) at the corners they share: paths run
+    # between corners not shared by exactly two edges, the rest close into rings; corners inside straight runs are dropped
+    edges = [((r0, c0), (r1, c1)) for r0, c0, r1, c1 in np.asarray(segments).reshape(-1, 4).tolist()]
+    ends = {}
+    for k, (a, b) in enumerate(edges):
+        ends.setdefault(a, []).append(k)
+        ends.setdefault(b, []).append(k)
+    used = [False] * len(edges)
+    paths = []
+    for corner in [c for c in sorted(ends) if len(ends[c])!=2] + sorted(ends):
+        for k in ends[corner]:
+            if used[k]:
+                continue
+            path, at = [corner], corner
+            while k is not None:
+                used[k] = True
+                at = edges[k][1] if edges[k][0]==at else edges[k][0]
+                path.append(at)
+                k = next((j for j in ends[at] if not used[j]), None) if len(ends[at])==2 else None
+            paths.append([path[0]] + [b for a, b, c in zip(path[:-2], path[1:-1], path[2:])
+                                      if not (a[0]==b[0]==c[0] or a[1]==b[1]==c[1])] + [path[-1]])
+    return paths
+
+
+def hilbertorder(xs, ys, bits=16):
+
+    # Order of points along a Hilbert curve over their bounding box, on a 2^bits x 2^bits grid
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    n = 1 << bits
+    scale = float(max(xs.max() - xs.min(), ys.max() - ys.min())) if xs.size else 0.0
+    scale = (n - 1) / scale if scale>0 else 0.0
+    x = np.round((xs - xs.min()) * scale).astype(np.int64) if xs.size else xs.astype(np.int64)
+    y = np.round((ys - ys.min()) * scale).astype(np.int64) if ys.size else ys.astype(np.int64)
+    d = np.zeros(x.size, dtype=np.int64)
+    s = n >> 1
+    while s>0:
+        rx = (x & s)>0
+        ry = (y & s)>0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+
+        # Rotate the quadrant so that the curve stays continuous
+        flip = ~ry & rx
+        x[flip], y[flip] = n - 1 - x[flip], n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return np.argsort(d, kind="mergesort")
+
+
+def tilecache(maxtiles, size=256):
+
+    # Bounded LRU cache of raster tiles of size x size cells, shared by the registered rasters
+    return {"max": maxtiles, "size": size, "tiles": collections.OrderedDict(), "rasters": {}, "hits": 0, "misses": 0}
+
+
+def cacheraster(cache, name, read, shape, transform):
+
+    # Register a raster: read(row0, row1, col0, col1) returns its cells as float64 with NaN for NoData
+    cache["rasters"][name] = (read, shape, transform)
+
+
+def cachedwindow(cache, name, row0, row1, col0, col1):
+
+    # Window [row0, row1) x [col0, col1) of a registered raster assembled from its tiles; cells off the raster are NaN
+    read, shape, transform = cache["rasters"][name]
+    size, tiles = cache["size"], cache["tiles"]
+    window = np.full((row1 - row0, col1 - col0), np.nan)
+    for tr in range(max(row0, 0) // size, (min(row1, shape[0]) - 1) // size + 1):
+        for tc in range(max(col0, 0) // size, (min(col1, shape[1]) - 1) // size + 1):
+            key = (name, tr, tc)
+            tile = tiles.pop(key, None)
+            if tile is None:
+                cache["misses"] += 1
+                tile = read(tr * size, min((tr + 1) * size, shape[0]), tc * size, min((tc + 1) * size, shape[1]))
+                while tiles and len(tiles)>=cache["max"]:
+                    tiles.popitem(last=False) # least recently used
+            else:
+                cache["hits"] += 1
+            tiles[key] = tile
+            r0, r1 = max(row0, tr * size), min(row1, tr * size + tile.shape[0])
+            c0, c1 = max(col0, tc * size), min(col1, tc * size + tile.shape[1])
+            window[r0 - row0:r1 - row0, c0 - col0:c1 - col0] = tile[r0 - tr * size:r1 - tr * size, c0 - tc * size:c1 - tc * size]
+    return window
@@ -1,5 +1,5 @@
-# Check 1 to 10 and run it within Python IDLE outside ArcMap
-# Output: RES_1234, DAM_1234, records.csv
+# Check 1 to 22 and run it within Python IDLE outside ArcMap
+# Output: RES_1234, DAM_1234 (or RESERVOIRS, DAMS - Check 17), sites.sqlite (Check 16), records.csv, damheights.csv (Check 13), footprints.npz, journal.csv, trace.jsonl, trace_summary.csv (Check 22)
 # Bug reports to: bin.lu@anu.edu.au
 
 import os
@@ -27,6 +27,18 @@ maxdamheight = 40 # Check 7 - Max dam height: 40 m
 minrescells = 111 # Check 8 - Min reservoir surface area: 10 ha (111 cells)
 dambatter = 1 # Check 9 - Dam batter 1:1
 screenrange = "All" # Check 10 - "All" or range(x ,y)
+processes = 1 # Check 11 - Number of worker processes: 1 screens the pour points one at a time
+watershedengine = "ArcGIS" # Check 12 - "ArcGIS" (Watershed per point) or "NumPy" (all watersheds in one pass)
+damheights = [] # Check 13 - Dam heights read off the hypsometric curve, e.g. [20, 30, 40, 60]; [] to skip
+metricsengine = "ArcGIS" # Check 14 - "ArcGIS" (projected polygons) or "NumPy" (grid cells with geodesic areas/lengths)
+resume = False # Check 15 - True to skip the pour points already in journal.csv and retry the errored ones
+store = "sites.sqlite" # Check 16 - SQLite store of the sites (typed and indexed), read by PrettySet in one query
+output = "PerSite" # Check 17 - "PerSite" (RES_1234, DAM_1234) or "Consolidated" (RESERVOIRS, DAMS keyed by PPT_ID)
+prefilter = False # Check 18 - True to skip the pour points with fewer upstream cells (flow accumulation) than minrescells
+schedule = "OBJECTID" # Check 19 - "OBJECTID" or "Hilbert" (neighbouring pour points one after another; damheights.csv and merges then follow the curve)
+cachetiles = 64 # Check 20 - Tiles of 256 x 256 cells of highland/landslope kept in memory by the "NumPy" engines
+memocells = 20000000 # Check 21 - Cells of nested watershed elevations memoized by the "NumPy" watershed engine
+tracing = True # Check 22 - True to time every stage of every pour point (trace.jsonl) and print where the time went
 
 
 # Launch
@@ -39,11 +51,13 @@ if __name__=="__main__":
     print "Workspace: " + arcpy.env.workspace
     print "Current working directory: " + os.getcwd()
 
-    # Clear the record file (if there is)
-    try:
-        os.unlink(os.path.join(directory, "records.csv"))
-    except OSError:
-        pass
+    # Clear the record files (if there are), unless an interrupted screen is resumed
+    for record in ["records.csv", "damheights.csv", "journal.csv", "trace.jsonl", store, store + "-wal", store + "-shm"]:
+        try:
+            if not resume:
+                os.unlink(os.path.join(directory, record))
+        except OSError:
+            pass
     
     # Check/CheckOut the Spatial Analyst extension
     class LicenseError(Exception):
@@ -0,0 +1,105 @@
+# Streamed KMZ of the pretty set for PrettySet: one site at a time into doc.kml, in one KMZ or one per region of degrees.
+# Bug reports to: bin.lu@anu.edu.au
+
+import os
+import sys
+import zipfile
+from xml.sax.saxutils import escape
+
+# Styles of the placemarks: outline and fill colours (aabbggrr)
+styles = {"reservoir": ("ffff5500", "80ff5500"), "dam": ("ff0000ff", "c00000ff")}
+
+
+def kmzopen(path, name):
+
+    # Open a KMZ for streaming and write the head of its document
+    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    if sys.version_info>=(3, 6):
+        stream, spill = archive.open("doc.kml", "w", force_zip64=True), None
+    else:
+        spill = path + ".kml"
+        stream = open(spill, "wb")
+    kmz = {"archive": archive, "stream": stream, "spill": spill, "placemarks": 0}
+    kmzwrite(kmz, '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n' +
+             "<name>" + escape(name) + "</name>\n")
+    for style, (line, fill) in sorted(styles.items()):
+        kmzwrite(kmz, '<Style id="' + style + '"><LineStyle><color>' + line + "</color><width>2</width></LineStyle>" +
+                 "<PolyStyle><color>" + fill + "</color></PolyStyle></Style>\n")
+    return kmz
+
+
+def kmzwrite(kmz, text):
+
+    # Append text to doc.kml
+    kmz["stream"].write(text.encode("utf-8"))
+
+
+def coordinates(ring):
+
+    # KML coordinates of a ring of (longitude, latitude), closed
+    ring = list(ring)
+    if ring and ring[0]!=ring[-1]:
+        ring.append(ring[0])
+    return " ".join("%.7f,%.7f" % (x, y) for x, y in ring)
+
+
+def placemark(kmz, name, style, attributes, polygons):
+
+    # Write a placemark: attributes [(field, value)] as extended data, polygons as [[outer ring, hole, ...], ...]
+    text = ["<Placemark><name>" + escape(name) + "</name><styleUrl>#" + style + "</styleUrl>", "<ExtendedData>"]
+    for field, value in attributes:
+        if value is not None:
+            text.append('<Data name="' + escape(field) + '"><value>' + escape(str(value)) + "</value></Data>")
+    text.append("</ExtendedData><MultiGeometry>")
+    for rings in polygons:
+        text.append("<Polygon><outerBoundaryIs><LinearRing><coordinates>" + coordinates(rings[0]) +
+                    "</coordinates></LinearRing></outerBoundaryIs>")
+        for hole in rings[1:]:
+            text.append("<innerBoundaryIs><LinearRing><coordinates>" + coordinates(hole) +
+                        "</coordinates></LinearRing></innerBoundaryIs>")
+        text.append("</Polygon>")
+    text.append("</MultiGeometry></Placemark>\n")
+    kmzwrite(kmz, "".join(text))
+    kmz["placemarks"] += 1
+
+
+def kmzclose(kmz):
+
+    # Close the document and the archive; return the number of placemarks
+    kmzwrite(kmz, "</Document>\n</kml>\n")
+    kmz["stream"].close()
+    if kmz["spill"] is not None:
+        kmz["archive"].write(kmz["spill"], "doc.kml")
+        os.remove(kmz["spill"])
+    kmz["archive"].close()
+    return kmz["placemarks"]
+
+
+def regionname(lat, lon, degrees):
+
+    # Name of the region of a grid of degrees holding a point, by its south-west corner: e.g. S36E138
+    south, west = (lat // degrees) * degrees, (lon // degrees) * degrees
+    return ("S" if south<0 else "N") + "%g" % abs(south) + ("W" if west<0 else "E") + "%g" % abs(west)
+
+
+def kmzset(directory, prefix, degrees=0):
+
+    # KMZs of a prefix opened on first use: one (prefix.kmz), or one per region of a grid of degrees (prefix_S36E138.kmz)
+    return {"directory": directory, "prefix": prefix, "degrees": degrees, "open": {}}
+
+
+def kmzsite(kmzs, lat, lon):
+
+    # KMZ of the region holding a pour point
+    key = kmzs["prefix"] if not kmzs["degrees"] else kmzs["prefix"] + "_" + regionname(lat, lon, kmzs["degrees"])
+    if key not in kmzs["open"]:
+        kmzs["open"][key] = kmzopen(os.path.join(kmzs["directory"], key + ".kmz"), key)
+    return kmzs["open"][key]
+
+
+def kmzcloseall(kmzs):
+
+    # Close every KMZ of the set: {file name: number of placemarks}
+    closed = dict((key + ".kmz", kmzclose(kmz)) for key, kmz in kmzs["open"].items())
+    kmzs["open"].clear()
+    return closed
@@ -0,0 +1,180 @@
+# NumPy outlines of the pretty set for PrettySet: reservoir rings traced from the footprints, dam strips as Buffer and
+# Erase make them, both smoothed as SmoothPolygon (PAEK) does - all sites in one batch.
+# Bug reports to: bin.lu@anu.edu.au
+
+import numpy as np
+
+# Steps (row, col) of the edge directions: east, north, west, south (anticlockwise on the map)
+steps = np.array([[0, 1], [-1, 0], [0, -1], [1, 0]], dtype=np.int64)
+
+
+def runcells(footprints):
+
+    # Cells of footprints [runs, ...] at once: site index and linear cell of every cell
+    runs = np.concatenate(footprints).reshape(-1, 2) if footprints else np.zeros((0, 2), dtype=np.int64)
+    lengths = runs[:, 1] - runs[:, 0]
+    site = np.repeat(np.repeat(np.arange(len(footprints), dtype=np.int64), [len(r) for r in footprints]), lengths)
+    offset = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return site, np.repeat(runs[:, 0], lengths) + offset
+
+
+def member(keys, table):
+
+    # Whether each key is in a sorted table
+    pos = np.minimum(np.searchsorted(table, keys), max(len(table) - 1, 0))
+    return table[pos]==keys if len(table) else np.zeros(len(keys), dtype=np.bool_)
+
+
+def boundaryedges(site, cell, rows, cols):
+
+    # Directed cell edges on the boundary of the cells of each site, inside on the left (outer rings anticlockwise):
+    # site, start corner (row, col) and direction (0 east, 1 north, 2 west, 3 south)
+    table = np.sort(site * rows * cols + cell)
+    r, c = cell // cols, cell % cols
+    edges = []
+    for direction, (dr, dc), (sr, sc) in [(0, (1, 0), (1, 0)), (1, (0, 1), (1, 1)), (2, (-1, 0), (0, 1)), (3, (0, -1), (0, 0))]:
+        nr, nc = r + dr, c + dc
+        inside = (nr>=0) & (nr<rows) & (nc>=0) & (nc<cols)
+        inside[inside] = member(site[inside] * rows * cols + nr[inside] * cols + nc[inside], table)
+        edges.append((site[~inside], r[~inside] + sr, c[~inside] + sc, np.full((~inside).sum(), direction, dtype=np.int64)))
+    return [np.concatenate(e) for e in zip(*edges)]
+
+
+def rings(site, r, c, direction, rows, cols):
+
+    # Join directed edges into rings; at a corner shared by two diagonal cells the left turn is taken (4-connected cells)
+    # Return the site of each ring, ring pointers (ring k is vertices[ptr[k]:ptr[k + 1]]) and the vertices (row, col)
+    n = len(site)
+    corner = lambda s, i, j: (s * (rows + 1) + i) * (cols + 1) + j
+    start = corner(site, r, c)
+    end = corner(site, r + steps[direction, 0], c + steps[direction, 1])
+    order = np.argsort(start, kind="mergesort")
+    first = np.searchsorted(start[order], end)
+    nxt = order[np.minimum(first, n - 1)]
+    pinch = (first + 1<n) & (start[order[np.minimum(first + 1, n - 1)]]==end)
+    nxt = np.where(pinch & (direction[nxt]!=(direction + 1) % 4), order[np.minimum(first + 1, n - 1)], nxt)
+
+    # Pointer jumping: the smallest edge of each ring leads it, and the edges are ranked by their steps to its last edge
+    label, jump = np.arange(n), nxt.copy()
+    for k in range(int(np.ceil(np.log2(max(n, 2)))) + 1):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+    last = nxt==label
+    rank, jump = np.where(last, 0, 1), np.where(last, np.arange(n), nxt)
+    for k in range(int(np.ceil(np.log2(max(n, 2)))) + 1):
+        rank = rank + rank[jump]
+        jump = jump[jump]
+    order = np.lexsort((-rank, label))
+    leaders, counts = np.unique(label, return_counts=True)
+    ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return site[leaders], ptr, np.column_stack([r[order], c[order]]).astype(np.float64)
+
+
+def trace(site, cell, rows, cols):
+
+    # Rings of the cells of every site on a grid of rows x cols
+    return rings(*(boundaryedges(site, cell, rows, cols) + [rows, cols]))
+
+
+def smooth(ptr, vertices, tolerance, resample=4):
+
+    # PAEK-like smoothing of rings of unit edges: resample points per edge, then each vertex moved to the average of
+    # the points within tolerance / 2 (cells) along its ring with exponentially decaying weights
+    length = np.diff(ptr)
+    if len(vertices)==0:
+        return vertices
+    ring = np.repeat(np.arange(len(length)), length)
+    pos = np.arange(len(vertices)) - ptr[ring]
+    following = vertices[ptr[ring] + (pos + 1) % length[ring]]
+    fraction = np.arange(resample, dtype=np.float64) / resample
+    points = (vertices[:, None, :] + (following - vertices)[:, None, :] * fraction[None, :, None]).reshape(-1, 2)
+
+    # Vertex k of a ring is its point k * resample
+    base, size, pos = ptr[ring] * resample, length[ring] * resample, pos * resample
+    half = int(tolerance * resample / 2)
+    total, weight = np.zeros(vertices.shape), np.zeros(len(vertices))
+    for k in range(-half, half + 1):
+        w = np.where(abs(k)<=(size - 1) // 2, np.exp(-3.0 * abs(k) / max(half, 1)), 0.0)
+        total += w[:, None] * points[base + (pos + k) % size]
+        weight += w
+    return total / weight[:, None]
+
+
+def damstrip(site, cell, segments, rows, cols, factor, width=1):
+
+    # Subcells of the dam strips on a grid factor times finer: width subcells along the outer side of each dam cell edge,
+    # as Buffer and Erase of the reservoir make them; the strip runs on past the corners where dam edges meet
+    # segments: site and corners (row0, col0, row1, col1) of dam lines along cell edges, any length
+    seg = np.asarray(segments, dtype=np.int64).reshape(-1, 5)
+    s, r0, c0, r1, c1 = seg.T
+    length = np.abs(r1 - r0) + np.abs(c1 - c0)
+    k = np.arange(length.sum(), dtype=np.int64) - np.repeat(np.cumsum(length) - length, length)
+    s, dr, dc = np.repeat(s, length), np.repeat(np.sign(r1 - r0), length), np.repeat(np.sign(c1 - c0), length)
+    ur, uc = np.repeat(r0, length) + dr * k, np.repeat(c0, length) + dc * k
+    ur, uc = np.minimum(ur, ur + dr), np.minimum(uc, uc + dc)
+    horizontal = dr==0
+
+    # Corners where dam edges meet: the strip is extended past them
+    corners = [s * (rows + 1) * (cols + 1) + ur * (cols + 1) + uc,
+               s * (rows + 1) * (cols + 1) + (ur + 1 - horizontal) * (cols + 1) + uc + horizontal]
+    shared, counts = np.unique(np.concatenate(corners), return_counts=True)
+    joined = [counts[np.searchsorted(shared, e)]>=2 for e in corners]
+
+    # Strip rectangles (subcell rows and columns) on each side of an edge whose cell is not in the reservoir
+    table = np.sort(site * rows * cols + cell)
+    rects = []
+    for side in [0, 1]:
+        cr, cc = np.where(horizontal, ur - 1 + side, ur), np.where(horizontal, uc, uc - 1 + side)
+        outside = (cr<0) | (cr>=rows) | (cc<0) | (cc>=cols) | ~member(s * rows * cols + cr * cols + cc, table)
+        across = np.where(side==0, factor * np.where(horizontal, ur, uc) - width, factor * np.where(horizontal, ur, uc))
+        along0 = factor * np.where(horizontal, uc, ur) - width * joined[0]
+        along1 = factor * (np.where(horizontal, uc, ur) + 1) + width * joined[1]
+        row0, row1 = np.where(horizontal, across, along0), np.where(horizontal, across + width, along1)
+        col0, col1 = np.where(horizontal, along0, across), np.where(horizontal, along1, across + width)
+        rects.append(np.column_stack([s, row0, row1, col0, col1])[outside])
+    rects = np.concatenate(rects)
+
+    # Subcells of the rectangles inside the grid and outside the reservoir, once each
+    height, breadth = rects[:, 2] - rects[:, 1], rects[:, 4] - rects[:, 3]
+    area = height * breadth
+    k = np.arange(area.sum(), dtype=np.int64) - np.repeat(np.cumsum(area) - area, area)
+    ss = np.repeat(rects[:, 0], area)
+    sr, sc = np.repeat(rects[:, 1], area) + k // np.repeat(breadth, area), np.repeat(rects[:, 3], area) + k % np.repeat(breadth, area)
+    keep = (sr>=0) & (sr<rows * factor) & (sc>=0) & (sc<cols * factor)
+    ss, sr, sc = ss[keep], sr[keep], sc[keep]
+    keep = ~member(ss * rows * cols + (sr // factor) * cols + sc // factor, table)
+    keys = np.unique(ss[keep] * rows * cols * factor * factor + sr[keep] * cols * factor + sc[keep])
+    return keys // (rows * cols * factor * factor), keys % (rows * cols * factor * factor)
+
+
+def inring(point, ring):
+
+    # Whether a point is inside a ring (ray casting)
+    x, y = point
+    x0, y0 = ring[:, 0], ring[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    crossing = ((y0>y)!=(y1>y)) & (x<x0 + (y - y0) * (x1 - x0) / np.where(y1!=y0, y1 - y0, 1))
+    return bool(crossing.sum() % 2)
+
+
+def polygons(sites, ptr, vertices, left, top, cellsize):
+
+    # Rings in map coordinates as polygons of each site: {site: [[outer ring, hole, ...], ...]} of (x, y)
+    xy = np.column_stack([left + vertices[:, 1] * cellsize, top - vertices[:, 0] * cellsize])
+    shifted = np.roll(xy, -1, axis=0)
+    shifted[ptr[1:] - 1] = xy[ptr[:-1]]
+    cross = xy[:, 0] * shifted[:, 1] - shifted[:, 0] * xy[:, 1]
+    area = np.add.reduceat(cross, ptr[:-1]) / 2 if len(xy) else np.zeros(0)
+    outers, holes = {}, []
+    for k in range(len(sites)):
+        ring = xy[ptr[k]:ptr[k + 1]]
+        if area[k]>0:
+            outers.setdefault(int(sites[k]), []).append([ring])
+        else:
+            holes.append((int(sites[k]), ring))
+    for site, ring in holes:
+        parts = outers.get(site, [])
+        owner = parts[0] if len(parts)==1 else next((p for p in parts if inring(ring[0], p[0])), None)
+        if owner is not None:
+            owner.append(ring)
+    return outers
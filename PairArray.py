@@ -0,0 +1,158 @@
+# Pair upper and lower reservoir sites into off-river PHES systems, ranked by energy storage.
+# Lower sites go into a KD-tree (scipy, or a grid of buckets) on geocentric coordinates, queried by batches of upper sites.
+# Check 1 to 8 before running the script stand-alone.
+# Input: sites.sqlite (upper reservoirs: DryGully on DEM_SA300UP), sites_low.sqlite (lower reservoirs: DryGully on
+# DEM_SA300LOW from PinkMap, with highland = "DEM_SA300LOW" and store = "sites_low.sqlite" in Interface - Check 3, 16)
+# Output: pairs.csv
+# Bug reports to: bin.lu@anu.edu.au
+
+import os
+import csv
+import numpy as np
+import datetime as dt
+import SiteStore
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Set working directory and input datasets
+directory = r"D:\SA" # Check 1
+upperstore = "sites.sqlite" # Check 2 - Upper reservoirs stored by DryGully
+lowerstore = "sites_low.sqlite" # Check 3 - Lower reservoirs stored by DryGully screening DEM_SA300LOW
+heads = range(200, 501, 100) # Check 4 - Altitude difference: pairs from the smallest to the largest head
+slopes = [15] # Check 5 - Head to horizontal distance ratio: horizontal distance up to head * the largest slope
+efficiency = 0.9 # Check 6 - Generation efficiency of the energy storage estimate
+bestof = 3 # Check 7 - Pairs kept per upper reservoir, best energy first; 0 to keep all
+batchsize = 4096 # Check 8 - Upper reservoirs queried at once
+
+
+def siteset(path):
+
+    # Pour points, elevations and volumes of the sites of a store, as arrays in OBJECTID order
+    sites = SiteStore.fetch(path)
+    oids = sorted(sites)
+    field = lambda f: np.array([sites[oid][f] for oid in oids], dtype=np.float64)
+    return {"oid": np.array(oids, dtype=np.int64), "lat": field("Lat"), "lon": field("Long"),
+            "elev": field("Elevation_m"), "volume": field("Reservoir_volume_GL")}
+
+
+def geocentric(lat, lon):
+
+    # Geocentric (x, y, z) in metres of points on the WGS84 ellipsoid
+    a, f = 6378137.0, 1 / 298.257223563
+    e2 = f * (2 - f)
+    lat, lon = np.radians(lat), np.radians(lon)
+    n = a / np.sqrt(1 - e2 * np.sin(lat)**2)
+    return np.column_stack([n * np.cos(lat) * np.cos(lon), n * np.cos(lat) * np.sin(lon), n * (1 - e2) * np.sin(lat)])
+
+
+def gridneighbours(points, queries, radius):
+
+    # Without scipy: indices of points within radius of each query, from buckets of radius-sized cubes
+    keys = np.floor(points / radius).astype(np.int64)
+    buckets = {}
+    for k, key in enumerate(map(tuple, keys.tolist())):
+        buckets.setdefault(key, []).append(k)
+    steps = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+    found = []
+    for q, key in zip(queries, np.floor(queries / radius).astype(np.int64).tolist()):
+        near = [p for s in steps for p in buckets.get((key[0] + s[0], key[1] + s[1], key[2] + s[2]), [])]
+        near = np.array(near, dtype=np.int64)
+        found.append(near[((points[near] - q)**2).sum(axis=1)<=radius * radius].tolist() if near.size else [])
+    return found
+
+
+def pairsites(upper, lower, minhead, maxhead, slope, size=4096):
+
+    # Every upper/lower pair with minhead <= head <= maxhead and horizontal distance <= head * slope
+    # Return the upper and lower indices, heads (m) and horizontal distances (m)
+    up, low = geocentric(upper["lat"], upper["lon"]), geocentric(lower["lat"], lower["lon"])
+    radius = maxhead * slope
+    tree = cKDTree(low) if cKDTree is not None and len(low) else None
+    ui, li = [], []
+    for start in range(0, len(up), size):
+        queries = up[start:start + size]
+        if tree is not None:
+            found = tree.query_ball_point(queries, radius)
+        else:
+            found = gridneighbours(low, queries, radius) if len(low) else [[] for q in queries]
+
+        # Candidates of the batch flattened into arrays and filtered at once
+        counts = np.array([len(f) for f in found], dtype=np.int64)
+        if counts.sum()==0:
+            continue
+        u = np.repeat(np.arange(start, start + len(queries), dtype=np.int64), counts)
+        l = np.concatenate([np.asarray(f, dtype=np.int64) for f in found if len(f)])
+        head = upper["elev"][u] - lower["elev"][l]
+        distance = np.sqrt(((up[u] - low[l])**2).sum(axis=1))
+        keep = (head>=minhead) & (head<=maxhead) & (distance<=head * slope)
+        ui.append(u[keep])
+        li.append(l[keep])
+    ui = np.concatenate(ui) if ui else np.zeros(0, dtype=np.int64)
+    li = np.concatenate(li) if li else np.zeros(0, dtype=np.int64)
+    head = upper["elev"][ui] - lower["elev"][li]
+    distance = np.sqrt(((up[ui] - low[li])**2).sum(axis=1))
+    return ui, li, head, distance
+
+
+def energy(head, volume, efficiency):
+
+    # Energy storage (GWh) of volume (GL) dropping through head (m): rho * g * h * V * efficiency
+    return 1000 * 9.81 * head * volume * pow(10, 6) * efficiency / 3.6e12
+
+
+def rankpairs(upper, lower, ui, li, head, distance, efficiency, bestof=0):
+
+    # Pairs ranked by energy storage (then shorter distance), keeping the best bestof per upper reservoir (0 for all)
+    volume = np.minimum(upper["volume"][ui], lower["volume"][li])
+    gwh = energy(head, volume, efficiency)
+    order = np.lexsort((distance, -gwh))
+    if bestof>0:
+        byupper = np.lexsort((distance, -gwh, ui)) # by upper reservoir, best first
+        first = np.searchsorted(ui[byupper], ui[byupper], side="left")
+        keep = byupper[np.arange(byupper.size) - first<bestof]
+        order = keep[np.lexsort((distance[keep], -gwh[keep]))]
+    return {"Upper": upper["oid"][ui[order]], "Lower": lower["oid"][li[order]], "Head_m": head[order],
+            "Distance_m": distance[order], "Slope": distance[order] / head[order], "Volume_GL": volume[order],
+            "Energy_GWh": gwh[order]}
+
+
+def savepairs(path, pairs):
+
+    # Write the ranked pairs with a header, best first
+    fields = ["Upper", "Lower", "Head_m", "Distance_m", "Slope", "Volume_GL", "Energy_GWh"]
+    with open(path, "w") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Rank"] + fields)
+        for k in range(len(pairs["Upper"])):
+            writer.writerow([k + 1, "RES_" + str(pairs["Upper"][k]), "RES_" + str(pairs["Lower"][k])] + [pairs[f][k] for f in fields[2:]])
+
+
+if __name__=="__main__":
+
+    # Record the start time
+    starttime = dt.datetime.now()
+    print("Begins at: " + str(starttime))
+
+    # Check the stores exist: SiteStore would create a missing one empty and no pairs would be found
+    steps = [(upperstore, "run DryGully through Interface with highland = \"DEM_SA300UP\" and store = \"" + upperstore + "\""),
+             (lowerstore, "run PinkMap, then DryGully through Interface with highland = \"DEM_SA300LOW\" and store = \"" +
+                          lowerstore + "\"")]
+    missing = [(store, step) for store, step in steps if not os.path.exists(os.path.join(directory, store))]
+    for store, step in missing:
+        print(os.path.join(directory, store) + " not found: " + step + " (Check 3, 16).")
+
+    # Core
+    if not missing:
+        upper = siteset(os.path.join(directory, upperstore))
+        lower = siteset(os.path.join(directory, lowerstore))
+        print("Upper reservoirs: " + str(len(upper["oid"])) + ", lower reservoirs: " + str(len(lower["oid"])))
+        ui, li, head, distance = pairsites(upper, lower, min(heads), max(heads), max(slopes), batchsize)
+        pairs = rankpairs(upper, lower, ui, li, head, distance, efficiency, bestof)
+        savepairs(os.path.join(directory, "pairs.csv"), pairs)
+        print(str(len(ui)) + " pairs found, " + str(len(pairs["Upper"])) + " saved at " + str(dt.datetime.now()))
+
+    # Calculate the running time
+    endtime = dt.datetime.now()
+    print("Running time: " + str(endtime - starttime))
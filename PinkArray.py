@@ -0,0 +1,395 @@
+# NumPy engine of PinkMap.landsep: circular focal minimum/maximum as chords of running extrema, shared by all heads/slopes.
+# Large DEMs are streamed in tiles with a halo of one focal radius; UP/LOW are kept as bools, bit masks or run lengths.
+# Check 1 to 10 before running the script stand-alone.
+# Input: DEM_SAEG.npy (float with NaN as NoData, or integer with a NoData value - Check 10).
+# Output: SAEG300UP.npy, SAEG300LOW.npy, DEM_SAEG300UP.npy ("Bool"); SAEG300UP_bits.npy, ... ("Bits"); SAEG300UP_rle.npz, ... ("RLE")
+# Bug reports to: bin.lu@anu.edu.au
+
+import os
+import numpy as np
+import multiprocessing
+import datetime as dt
+
+# Set working directory and input datasets
+directory = r"D:\SA" # Check 1
+region = "SAEG" # Check 2 - Name of the target region
+demodel = "DEM_SAEG.npy" # Check 3 - Digital elevation model saved as a NumPy array
+heads = range(200, 501, 100) # Check 4 - Altitude difference
+slopes = [15] # Check 5 - Head to horizontal distance ratio
+resolution = 30 # Check 6 - Approx. 30 m for 1 arc-second DEM of SA
+tilesize = 0 # Check 7 - Tile size in cells for out-of-core runs, e.g. 2048; 0 to hold the whole DEM in memory
+processes = 1 # Check 8 - Number of worker processes for the tiles
+maskformat = "Bool" # Check 9 - "Bool" masks with DEM_*UP, "Bits" packed bit masks or "RLE" run-length encoded rows
+nodata = -32768 # Check 10 - NoData value of an integer DEM
+
+
+def readdem(path, mmap=True):
+
+    # DEM as stored, memory-mapped unless mmap is False; read it through demblock
+    return np.load(path, mmap_mode="r" if mmap else None)
+
+
+def demblock(dem, window=None):
+
+    # Block (row0, row1, col0, col1) of a DEM, or all of it, with NoData as NaN: integer DEMs are promoted to float32
+    # block by block, so a memory-mapped DEM is never copied whole
+    raw = dem if window is None else dem[window[0]:window[1], window[2]:window[3]]
+    if np.issubdtype(dem.dtype, np.floating):
+        return np.asarray(raw)
+    block = np.array(raw, dtype=np.float32)
+    block[raw==nodata] = np.nan
+    return block
+
+
+def chords(radius):
+
+    # Rows of an ArcGIS "Circle <radius> CELL" neighbourhood: a cell belongs to the circle if its centre is within the radius
+    # Returns (row offset, half width) pairs
+    reach = int(np.floor(radius))
+    return [(dy, int(np.floor(np.sqrt(radius * radius - dy * dy)))) for dy in range(-reach, reach + 1)]
+
+
+def lineextremum(values, halfwidth, stat):
+
+    # van Herk/Gil-Werman running extremum of width 2 * halfwidth + 1 along the last axis
+    # values must already be filled with the identity of stat (+inf for MINIMUM, -inf for MAXIMUM)
+    if halfwidth==0:
+        return values.copy()
+    func = np.minimum if stat=="MINIMUM" else np.maximum
+    fill = np.inf if stat=="MINIMUM" else -np.inf
+    width = 2 * halfwidth + 1
+    rows, cols = values.shape
+
+    # Pad both sides by the half width and round up to whole blocks
+    nblocks = -(-(cols + 2 * halfwidth) // width)
+    padded = np.full((rows, nblocks * width), fill, dtype=values.dtype)
+    padded[:, halfwidth:halfwidth + cols] = values
+    blocks = padded.reshape(rows, nblocks, width)
+
+    # Prefix extrema forward and suffix extrema backward within each block
+    forward = func.accumulate(blocks, axis=2).reshape(rows, -1)
+    backward = func.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(rows, -1)
+
+    # A window starting at x spans the tail of one block and the head of the next
+    return func(backward[:, :cols], forward[:, width - 1:width - 1 + cols])
+
+
+def focalstat(dem, radius, stat):
+
+    # Circular focal MINIMUM/MAXIMUM with the "DATA" option: NoData (NaN) is ignored
+    func = np.minimum if stat=="MINIMUM" else np.maximum
+    fill = np.inf if stat=="MINIMUM" else -np.inf
+    values = np.where(np.isnan(dem), fill, dem).astype(dem.dtype if np.issubdtype(dem.dtype, np.floating) else np.float32)
+    rows = values.shape[0]
+    result = np.full(values.shape, fill, dtype=values.dtype)
+
+    # Every distinct chord width is evaluated once and shared by all row offsets using it
+    widths = {}
+    for dy, halfwidth in chords(radius):
+        widths.setdefault(halfwidth, []).append(dy)
+    for halfwidth in sorted(widths):
+        line = lineextremum(values, halfwidth, stat)
+        for dy in widths[halfwidth]:
+            if abs(dy)>=rows:
+                continue
+            if dy>=0:
+                func(result[:rows - dy], line[dy:], out=result[:rows - dy])
+            else:
+                func(result[-dy:], line[:rows + dy], out=result[-dy:])
+
+    # Neighbourhoods without any data become NoData
+    result[np.isinf(result)] = np.nan
+    return result
+
+
+def focalsweep(dem, radii, stat):
+
+    # Circular focal MINIMUM/MAXIMUM for several radii at once: {radius: result}
+    # The circle of a larger radius contains the smaller one, so it only adds the chords that got wider or new rows;
+    # every chord width is evaluated once for the whole sweep
+    func = np.minimum if stat=="MINIMUM" else np.maximum
+    fill = np.inf if stat=="MINIMUM" else -np.inf
+    values = np.where(np.isnan(dem), fill, dem).astype(dem.dtype if np.issubdtype(dem.dtype, np.floating) else np.float32)
+    rows = values.shape[0]
+    radii = sorted(set(radii))
+
+    # Chords added by each radius over the previous one
+    widths = {}
+    previous = {}
+    for radius in radii:
+        current = dict(chords(radius))
+        for dy, halfwidth in current.items():
+            if previous.get(dy)!=halfwidth:
+                widths.setdefault(halfwidth, []).append((radius, dy))
+        previous = current
+
+    # Annulus of each radius
+    annuli = dict((radius, np.full(values.shape, fill, dtype=values.dtype)) for radius in radii)
+    for halfwidth in sorted(widths):
+        line = lineextremum(values, halfwidth, stat)
+        for radius, dy in widths[halfwidth]:
+            if abs(dy)>=rows:
+                continue
+            result = annuli[radius]
+            if dy>=0:
+                func(result[:rows - dy], line[dy:], out=result[:rows - dy])
+            else:
+                func(result[-dy:], line[:rows + dy], out=result[-dy:])
+        del line
+
+    # Nest the annuli from the smallest circle outwards
+    for i in range(1, len(radii)):
+        func(annuli[radii[i]], annuli[radii[i - 1]], out=annuli[radii[i]])
+    for radius in radii:
+        annuli[radius][np.isinf(annuli[radius])] = np.nan
+    return annuli
+
+
+def landsep(head, slope, cellsize, dem):
+
+    # Same masks as PinkMap.landsep: True where a cell qualifies
+    masks = {}
+    radius = head * slope / float(cellsize) # e.g. 300 m - 4.5 km - 150 cells
+
+    # "MINIMUM" for upper reservoirs while "MAXIMUM" for lower reservoirs
+    for stat in [("MINIMUM", "UP"), ("MAXIMUM", "LOW")]:
+
+        # Focal Statistics
+        focal = focalstat(dem, radius, stat[0])
+        print(stat[0] + " Focal Statistics finished at " + str(dt.datetime.now()))
+
+        # Raster Calculator and Set Null: NaN compares False, so NoData never qualifies
+        with np.errstate(invalid="ignore"):
+            elevdiff = dem - focal
+            masks[stat[1]] = elevdiff > head if stat[0]=="MINIMUM" else elevdiff < -1 * head
+        print(stat[0] + " Set Null finished at " + str(dt.datetime.now()))
+
+    # Extract by Mask
+    demup = np.where(masks["UP"], dem, np.nan).astype(focal.dtype)
+    return masks["UP"], masks["LOW"], demup
+
+
+def landsweep(heads, slopes, cellsize, dem, packed=False):
+
+    # landsep for every (head, slope) at once: {(head, slope): (UP, LOW)}, packed into bits if requested
+    masks = dict(((head, slope), {}) for head in heads for slope in slopes)
+    radius = lambda head, slope: head * slope / float(cellsize)
+    elevdiff = None
+
+    # "MINIMUM" for upper reservoirs while "MAXIMUM" for lower reservoirs
+    for stat in [("MINIMUM", "UP"), ("MAXIMUM", "LOW")]:
+
+        # Focal Statistics of all radii
+        focal = focalsweep(dem, [radius(head, slope) for head, slope in masks], stat[0])
+        print(stat[0] + " Focal Statistics sweep of " + str(len(focal)) + " radii finished at " + str(dt.datetime.now()))
+
+        # Raster Calculator and Set Null, fused into one scratch buffer
+        with np.errstate(invalid="ignore"):
+            for head, slope in masks:
+                focalrad = focal[radius(head, slope)]
+                if elevdiff is None:
+                    elevdiff = np.empty_like(focalrad)
+                np.subtract(dem, focalrad, out=elevdiff)
+                mask = elevdiff > head if stat[0]=="MINIMUM" else elevdiff < -1 * head
+                masks[(head, slope)][stat[1]] = packmask(mask) if packed else mask
+        del focal
+
+    return dict((key, (value["UP"], value["LOW"])) for key, value in masks.items())
+
+
+def packmask(mask):
+
+    # Pack a boolean mask into 8 cells per byte along the rows
+    return np.packbits(mask, axis=1)
+
+
+def maskvalue(bits, row, col):
+
+    # Look up one cell of a packed (possibly memory-mapped) mask
+    return bool((int(bits[row, col // 8]) >> (7 - col % 8)) & 1)
+
+
+def maskwindow(bits, row0, row1, col0, col1):
+
+    # Unpack a window of a packed mask; only the bytes covering the window are read
+    byte0, byte1 = col0 // 8, -(-col1 // 8)
+    window = np.unpackbits(np.asarray(bits[row0:row1, byte0:byte1]), axis=1)
+    return window[:, col0 - 8 * byte0:col1 - 8 * byte0].astype(np.bool_)
+
+
+def encoderuns(bits, cols, chunk=1024):
+
+    # Run-length encode a packed mask row by row: runs of row r are starts/ends[rowptr[r]:rowptr[r + 1]], ends exclusive
+    rows = bits.shape[0]
+    counts, starts, ends = [], [], []
+    for row0 in range(0, rows, chunk):
+        mask = maskwindow(bits, row0, min(row0 + chunk, rows), 0, cols)
+        edges = np.diff(np.pad(mask.astype(np.int8), ((0, 0), (1, 1)), mode="constant"), axis=1)
+        rowidx, start = np.nonzero(edges==1)
+        end = np.nonzero(edges==-1)[1]
+        counts.append(np.bincount(rowidx, minlength=mask.shape[0]))
+        starts.append(start.astype(np.int32))
+        ends.append(end.astype(np.int32))
+    rowptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))]).astype(np.int64)
+    return {"rowptr": rowptr, "starts": np.concatenate(starts), "ends": np.concatenate(ends),
+            "shape": np.array([rows, cols], dtype=np.int64)}
+
+
+def runvalue(runs, row, col):
+
+    # Look up one cell of a run-length encoded mask
+    first, last = runs["rowptr"][row], runs["rowptr"][row + 1]
+    i = first + np.searchsorted(runs["starts"][first:last], col, side="right") - 1
+    return bool(i>=first and col<runs["ends"][i])
+
+
+def runwindow(runs, row0, row1, col0, col1):
+
+    # Decode a window of a run-length encoded mask
+    window = np.zeros((row1 - row0, col1 - col0), dtype=np.bool_)
+    for row in range(row0, row1):
+        first, last = runs["rowptr"][row], runs["rowptr"][row + 1]
+        for start, end in zip(runs["starts"][first:last], runs["ends"][first:last]):
+            if end>col0 and start<col1:
+                window[row - row0, max(start, col0) - col0:min(end, col1) - col0] = True
+    return window
+
+
+def savemask(path, bits, cols, form):
+
+    # Save a packed mask as "Bits" (.npy, memory-mappable) or "RLE" (.npz)
+    if form=="RLE":
+        np.savez(path, **encoderuns(bits, cols))
+    else:
+        np.save(path, bits)
+
+
+def loadmask(path):
+
+    # Open a saved mask: a memory-mapped packed array for "Bits", a dict of run arrays for "RLE"
+    if path.endswith(".npz"):
+        with np.load(path) as runs:
+            return dict((key, runs[key]) for key in runs.files)
+    return np.load(path, mmap_mode="r")
+
+
+def tiles(shape, size, halo):
+
+    # Core window and halo window (row0, row1, col0, col1) of every tile
+    rows, cols = shape
+    for row in range(0, rows, size):
+        for col in range(0, cols, size):
+            core = (row, min(row + size, rows), col, min(col + size, cols))
+            window = (max(core[0] - halo, 0), min(core[1] + halo, rows), max(core[2] - halo, 0), min(core[3] + halo, cols))
+            yield core, window
+
+
+def outputnames(outdir, name, head, form="Bool"):
+
+    # Output files of a head: UP, LOW and, for "Bool" only, DEM_<region><head>UP
+    if form=="Bool":
+        return (os.path.join(outdir, name + str(head) + "UP.npy"),
+                os.path.join(outdir, name + str(head) + "LOW.npy"),
+                os.path.join(outdir, "DEM_" + name + str(head) + "UP.npy"))
+    suffix = "_rle.npz" if form=="RLE" else "_bits.npy"
+    return (os.path.join(outdir, name + str(head) + "UP" + suffix),
+            os.path.join(outdir, name + str(head) + "LOW" + suffix))
+
+
+def landtile(task):
+
+    # Run a landsep sweep on one tile (in a worker process) and write its core into the memory-mapped outputs
+    dempath, outdir, name, heads, slopes, cellsize, form, core, window = task
+    dem = readdem(dempath)
+    block = np.asarray(demblock(dem, window), dtype=np.float32)
+    crop = (slice(core[0] - window[0], core[1] - window[0]), slice(core[2] - window[2], core[3] - window[2]))
+    masks = landsweep(heads=heads, slopes=slopes, cellsize=cellsize, dem=block)
+    for head, slope in sorted(masks):
+        up, low = masks[(head, slope)]
+        if form=="Bool":
+            arrays = (up[crop], low[crop], np.where(up, block, np.nan).astype(np.float32)[crop])
+            columns = slice(core[2], core[3])
+        else:
+            arrays = (packmask(up[crop]), packmask(low[crop]))
+            columns = slice(core[2] // 8, -(-core[3] // 8))
+        for outpath, array in zip(outputnames(outdir, name, head, "Bits" if form=="RLE" else form), arrays):
+            out = np.load(outpath, mmap_mode="r+")
+            out[core[0]:core[1], columns] = array
+            out.flush()
+            del out
+    return core
+
+
+def landtiles(heads, slopes, cellsize, dempath, outdir, name, size=2048, nprocs=1, form="Bool"):
+
+    # Out-of-core landsweep: tiles are read with a halo of the largest focal radius, so results equal the in-memory run
+    # Packed outputs need tiles aligned to whole bytes
+    assert form=="Bool" or size % 8==0, "Tile size must be a multiple of 8 for packed masks."
+    dem = readdem(dempath)
+    shape = dem.shape
+    halo = int(np.floor(max(head * slope / float(cellsize) for head in heads for slope in slopes)))
+
+    # Allocate the memory-mapped outputs; RLE is encoded from the packed bits at the end
+    for head in heads:
+        if form=="Bool":
+            outputs = zip(outputnames(outdir, name, head), (np.bool_, np.bool_, np.float32), [shape] * 3)
+        else:
+            outputs = zip(outputnames(outdir, name, head, "Bits"), (np.uint8, np.uint8), [(shape[0], -(-shape[1] // 8))] * 2)
+        for outpath, dtype, outshape in outputs:
+            np.lib.format.open_memmap(outpath, mode="w+", dtype=dtype, shape=outshape).flush()
+
+    # Process the tiles on their own, in a pool of workers if requested
+    tasks = [(dempath, outdir, name, list(heads), list(slopes), cellsize, form, core, window)
+             for core, window in tiles(shape, size, halo)]
+    del dem
+    if nprocs>1:
+        pool = multiprocessing.Pool(nprocs)
+        done = pool.imap_unordered(landtile, tasks)
+    else:
+        pool = None
+        done = (landtile(task) for task in tasks)
+    for i, core in enumerate(done):
+        print("Tile " + str(i + 1) + "/" + str(len(tasks)) + " " + str(core) + " finished at " + str(dt.datetime.now()))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Run-length encode the packed masks
+    if form=="RLE":
+        for head in heads:
+            for bitspath, rlepath in zip(outputnames(outdir, name, head, "Bits"), outputnames(outdir, name, head, "RLE")):
+                bits = loadmask(bitspath)
+                savemask(rlepath, bits, shape[1], "RLE")
+                del bits
+                os.unlink(bitspath)
+
+
+if __name__=='__main__':
+
+    # Record the start time and working environment
+    starttime = dt.datetime.now()
+    print("Begins at: " + str(starttime))
+    print("NumPy version: " + np.__version__)
+    print("Current working directory: " + directory)
+
+    # Core
+    if tilesize>0:
+        landtiles(heads=heads, slopes=slopes, cellsize=resolution, dempath=os.path.join(directory, demodel),
+                  outdir=directory, name=region, size=tilesize, nprocs=processes, form=maskformat)
+    else:
+        dem = demblock(readdem(os.path.join(directory, demodel), mmap=False))
+        masks = landsweep(heads=heads, slopes=slopes, cellsize=resolution, dem=dem, packed=maskformat!="Bool")
+        for head, slope in sorted(masks):
+            up, low = masks[(head, slope)]
+            outputs = outputnames(directory, region, head, maskformat)
+            if maskformat=="Bool":
+                np.save(outputs[0], up)
+                np.save(outputs[1], low)
+                np.save(outputs[2], np.where(up, dem, np.nan).astype(dem.dtype))
+            else:
+                savemask(outputs[0], up, dem.shape[1], maskformat)
+                savemask(outputs[1], low, dem.shape[1], maskformat)
+
+    # Calculate the running time
+    endtime = dt.datetime.now()
+    print("Running time: " + str(endtime - starttime))
@@ -1,11 +1,13 @@
 # This script is to seperate a state/region into potential locations for upper and lower reservoirs of off-river PHES.
-# Check 1 to 7: Head (altitude difference) and head to horizontal distance ratio can be specified.
-# Output: DEM_SA300UP for DryGully.py
+# Check 1 to 8: Head (altitude difference) and head to horizontal distance ratio can be specified.
+# Output: DEM_SA300UP (upper reservoirs) and DEM_SA300LOW (lower reservoirs, for PairArray.py) for DryGully.py
 # Bug reports to: bin.lu@anu.edu.au
 
 import os
 import arcpy
+import numpy
 import datetime as dt
+import PinkArray
 
 # Set working directory and geodatabase
 directory = r"D:\SA" # Check 1
@@ -22,6 +24,7 @@ demodel = "DEM_SAEG" # Check 4 - Digital elevation model for the target region
 heads = range(200, 501, 100) # Check 5 - Altitude difference
 slopes = [15] # Check 6 - Head to horizontal distance ratio
 resolution = 30 # Check 7 - Approx. 30 m for 1 arc-second DEM of SA
+engine = "ArcGIS" # Check 8 - "ArcGIS" (Focal Statistics) or "NumPy" (PinkArray, no Spatial Analyst needed)
 
 
 def landsep(head, slope, cellsize):
@@ -45,11 +48,47 @@ def landsep(head, slope, cellsize):
         arcpy.gp.SetNull_sa(elevdiff, "-999", outrassn, wherec)
         print stat[0] + " Set Null finished at " + str(dt.datetime.now())
 
-        # Extract by Mask
-        if stat[1]=="LOW":
-            continue
+        # Extract by Mask: DEM_UP and DEM_LOW to be screened by DryGully
         outrasem = "DEM_" + region + str(head) + stat[1]
         arcpy.gp.ExtractByMask_sa(demodel, outrassn, outrasem)
+
+
+def demarray():
+
+    # Read the DEM into an array with NoData as NaN
+    dem = arcpy.Raster(demodel)
+    array = arcpy.RasterToNumPyArray(dem, nodata_to_value=-9999).astype(numpy.float32)
+    array[array==-9999] = numpy.nan
+    return dem, array
+
+
+def arrayraster(array, dem, outras, nodata):
+
+    # Write an array on the grid of the DEM
+    lowerleft = arcpy.Point(dem.extent.XMin, dem.extent.YMin)
+    arcpy.NumPyArrayToRaster(array, lowerleft, dem.meanCellWidth, dem.meanCellHeight, nodata).save(outras)
+    arcpy.DefineProjection_management(outras, dem.spatialReference)
+
+
+def landseparray(heads, slopes, cellsize):
+
+    # Same outputs as landsep for the whole sweep of heads and slopes, with the focal statistics computed by PinkArray
+    dem, array = demarray()
+    masks = PinkArray.landsweep(heads=heads, slopes=slopes, cellsize=cellsize, dem=array)
+
+    for head, slope in sorted(masks):
+        up, low = masks[(head, slope)]
+
+        # Set Null outputs hold -999 where a cell qualifies
+        for stat in [(up, "UP"), (low, "LOW")]:
+            outrassn = os.path.join("in_memory", region + str(head) + stat[1])
+            arrayraster(numpy.where(stat[0], -999, 0).astype(numpy.int16), dem, outrassn, 0)
+
+        # Extract by Mask: DEM_UP and DEM_LOW to be screened by DryGully
+        for stat in [(up, "UP"), (low, "LOW")]:
+            outrasem = "DEM_" + region + str(head) + stat[1]
+            arrayraster(numpy.where(stat[0], array, numpy.nan).astype(numpy.float32), dem, outrasem, numpy.nan)
+        print "NumPy landsep of head " + str(head) + " finished at " + str(dt.datetime.now())
         
 
 if __name__=='__main__':
@@ -72,9 +111,12 @@ if __name__=='__main__':
             raise LicenseError
 
         # Core
-        for head in heads:
-            for slope in slopes:
-                landsep(head=head, slope=slope, cellsize=resolution)
+        if engine=="NumPy":
+            landseparray(heads=heads, slopes=slopes, cellsize=resolution)
+        else:
+            for head in heads:
+                for slope in slopes:
+                    landsep(head=head, slope=slope, cellsize=resolution)
 
         # CheckIn the Spatial Analyst extension
         arcpy.CheckInExtension("Spatial")
@@ -1,9 +1,15 @@
 # Identify the overlapping polygons and produce a pretty set according to water-rock ratio.
 # Attach each dam to its reservoir.
-# Check 1 to 4 before running the script.
-# Output: RESDAM_1234_FC, RESDAM_1234.kmz
+# Check 1 to 11 before running the script.
+# Input: RES_1234, DAM_1234 or RESERVOIRS, DAMS (Check 8) from DryGully
+# Output: RESDAM_1234_FC or RESDAM (Check 11), RESDAM_1234.kmz or RESDAM.kmz, RESDAM_S36E138.kmz (Check 9 and 10)
 
 import arcpy
+import SetArray
+import GullyArray
+import OutlineArray
+import SiteStore
+import KmzWriter
 import glob
 import re
 import os
@@ -21,6 +27,24 @@ os.chdir(directory)
 # Set input datasets: Lists of reservoir and dam feature classes
 resfc = arcpy.ListFeatureClasses("RES_*") # Check 3
 damfc = arcpy.ListFeatureClasses("DAM_*") # Check 4
+resolver = "Indexed" # Check 5 - "Indexed" (grid index, each RES_ read once) or "Pairwise" (all pairs, as before)
+footprints = "footprints.npz" # Check 6 - Reservoir cell sets saved by DryGully; "" to intersect the polygons
+store = "sites.sqlite" # Check 7 - Sites stored by DryGully; "" to read each RES_ instead
+output = "PerSite" # Check 8 - "PerSite" (RES_1234, DAM_1234) or "Consolidated" (RESERVOIRS, DAMS keyed by PPT_ID)
+kml = "PerSite" # Check 9 - "PerSite" (RESDAM_1234.kmz by LayerToKML) or "Streamed" (all sites in RESDAM.kmz)
+kmlregion = 0 # Check 10 - "Streamed": degrees of the regions split into RESDAM_S36E138.kmz etc.; 0 for one RESDAM.kmz
+geometryengine = "ArcGIS" # Check 11 - "ArcGIS" (Buffer/Erase/Merge/SmoothPolygon per site) or "NumPy" (all sites at once into RESDAM from footprints.npz)
+
+# Rounding of the attributes of the pretty set
+integerfd = ["Water_area_ha", "Ground_area_ha", "Reservoir_volume_GL", "Dam_length_m", "Water_rock_ratio"]
+floatfd = ["Dam_area_ha", "Dam_volume_GL"]
+
+# Consolidated: the sites are listed from RESERVOIRS and DAMS with one cursor each, named as RES_1234/DAM_1234
+if output=="Consolidated":
+    with arcpy.da.SearchCursor("RESERVOIRS", ["PPT_ID"]) as cursor:
+        resfc = ["RES_" + str(i) for i in sorted(set(row[0] for row in cursor))]
+    with arcpy.da.SearchCursor("DAMS", ["PPT_ID"]) as cursor:
+        damfc = ["DAM_" + str(i) for i in sorted(set(row[0] for row in cursor))]
 print "Number of RES_: ", len(resfc)
 print "Number of DAM_: ", len(damfc)
 
@@ -37,6 +61,25 @@ for d in damidx:
 assert len(resfc)==len(damfc), "Find the missing data."
 
 
+def siteset(name):
+
+    # Dataset of a reservoir or dam by its RES_/DAM_ name: the feature class, or a layer of its rows in RESERVOIRS/DAMS
+    if output!="Consolidated":
+        return name
+    prefix, idx = name.split("_")
+    return arcpy.MakeFeatureLayer_management(in_features={"RES": "RESERVOIRS", "DAM": "DAMS"}[prefix], out_layer=name,
+                                             where_clause="PPT_ID = " + idx)
+
+
+def readsite(name, fields):
+
+    # First row of a reservoir or dam: from its feature class, or from RESERVOIRS/DAMS through the PPT_ID index
+    where = None if output!="Consolidated" else "PPT_ID = " + name.split("_")[-1]
+    dataset = name if output!="Consolidated" else {"RES": "RESERVOIRS", "DAM": "DAMS"}[name.split("_")[0]]
+    with arcpy.da.SearchCursor(dataset, fields, where) as cursor:
+        return cursor.next()
+
+
 def removal():
     
     rmvl = []
@@ -48,12 +91,12 @@ def removal():
                 continue
 
             # Get the latitudes and longitudes of i, j
-            cursor = arcpy.SearchCursor(resfc[i])
+            cursor = arcpy.SearchCursor(siteset(resfc[i]))
             row = cursor.next()
             lati = float(row.getValue("LAT"))
             loni = float(row.getValue("LONG"))
             
-            cursor = arcpy.SearchCursor(resfc[j])
+            cursor = arcpy.SearchCursor(siteset(resfc[j]))
             row = cursor.next()
             latj = float(row.getValue("LAT"))
             lonj = float(row.getValue("LONG"))
@@ -63,7 +106,7 @@ def removal():
                 continue
 
             # Calculate the intersection
-            intersection = arcpy.Intersect_analysis(in_features=[resfc[i], resfc[j]], out_feature_class="ijintersect")
+            intersection = arcpy.Intersect_analysis(in_features=[siteset(resfc[i]), siteset(resfc[j])], out_feature_class="ijintersect")
             cursor = arcpy.SearchCursor(intersection)
             area = [row.getValue("SHAPE_AREA") for row in cursor]
 
@@ -71,10 +114,8 @@ def removal():
             if area==[]:
                 continue
             else:
-                with arcpy.da.SearchCursor(resfc[i], "WATER_ROCK_RATIO") as cursor:
-                    ratioi = float([r for r in cursor][0][0])
-                with arcpy.da.SearchCursor(resfc[j], "WATER_ROCK_RATIO") as cursor:
-                    ratioj = float([r for r in cursor][0][0])
+                ratioi = float(readsite(resfc[i], ["WATER_ROCK_RATIO"])[0])
+                ratioj = float(readsite(resfc[j], ["WATER_ROCK_RATIO"])[0])
 
                 # Note the "worse" one in reml
                 if ratioi>=ratioj:
@@ -85,61 +126,207 @@ def removal():
                     print "RES_" + str(resfc[i]) + " removed"
                     break
 
+    return prettyset(rmvl)
+
+
+def removalindexed():
+
+    # Pour point, bounding box and water-rock ratio of every reservoir: one query of the store, or each RES_ read once
+    sites = SiteStore.fetch(os.path.join(directory, store)) if store and os.path.exists(os.path.join(directory, store)) else {}
+    lat, lon, bbox, ratio, shapes = [], [], [], [], {}
+    for i, fc in enumerate(resfc):
+        site = sites.get(int(fc.split("_")[-1]))
+        if site is not None:
+            row = (site["Lat"], site["Long"], site["Water_rock_ratio"], (site["XMin"], site["YMin"], site["XMax"], site["YMax"]))
+        else:
+            row = readsite(fc, ["LAT", "LONG", "WATER_ROCK_RATIO", "SHAPE@"])
+            shapes[i] = row[3]
+            row = row[:3] + ((row[3].extent.XMin, row[3].extent.YMin, row[3].extent.XMax, row[3].extent.YMax),)
+        lat.append(float(row[0]))
+        lon.append(float(row[1]))
+        ratio.append(float(row[2]))
+        bbox.append(row[3])
+
+    # Only nearby pairs with touching boxes are intersected, in memory: by their cell sets if DryGully saved them
+    # Polygons are read only for the reservoirs without a cell set
+    cellsets = SetArray.loadfootprints(os.path.join(directory, footprints)) if footprints and os.path.exists(os.path.join(directory, footprints)) else {}
+    runs = [cellsets.get(int(fc.split("_")[-1])) for fc in resfc]
+    def shape(i):
+        if i not in shapes:
+            shapes[i] = readsite(resfc[i], ["SHAPE@"])[0]
+        return shapes[i]
+    def intersects(i, j):
+        if runs[i] is not None and runs[j] is not None:
+            return SetArray.runsoverlap(runs[i], runs[j])
+        return shape(i).intersect(shape(j), 4).area>0
+    rmvl = SetArray.overlapremoval(lat, lon, bbox, ratio, intersects)
+    for x in rmvl:
+        print "RES_" + str(resfc[x]) + " removed"
+
+    return prettyset(rmvl)
+
+
+def prettyset(rmvl):
+
     idxrmvl = [int(resfc[x].split("_")[1]) for x in rmvl]
     print "Remove (removal index): " + str(rmvl)
     print "Remove (RES_): " + str(idxrmvl)
 
     # Extract the "better" polygon
-    resl = [x for x in resfc if resfc.index(x) not in rmvl]
-    daml = []
-    for y in resl:
-        for z in damfc:
-            if z.split("_")[-1]==y.split("_")[-1]:
-                daml.append(z)
+    removed = set(rmvl)
+    dambyidx = dict((z.split("_")[-1], z) for z in damfc)
+    resl = [x for k, x in enumerate(resfc) if k not in removed]
+    daml = [dambyidx[y.split("_")[-1]] for y in resl if y.split("_")[-1] in dambyidx]
     assert len(resl)==len(daml)
 
     return resl, daml
 
 
-def resdamcr8():
+def kmlpolygons(shape):
 
-    # Lists of reservoirs and dams in the pretty set
-    resl, daml = removal()
-    
+    # Rings of a polygon as [[outer ring, hole, ...], ...] of (longitude, latitude); holes follow a None in each part
+    polygons = []
+    for part in shape:
+        rings = [[]]
+        for point in part:
+            if point is None:
+                rings.append([])
+            else:
+                rings[-1].append((point.X, point.Y))
+        polygons.append([ring for ring in rings if ring])
+    return polygons
+
+
+def streamkmz(kmzs, resdam, fields):
+
+    # Reservoir and dam of a site as placemarks of the KMZ of its region, in WGS84 with their rounded attributes
+    with arcpy.da.SearchCursor(resdam, fields + ["SHAPE@"], spatial_reference=arcpy.SpatialReference(4326)) as cursor:
+        rows = [row for row in cursor]
+    lat, lon = [(row[fields.index("Lat")], row[fields.index("Long")]) for row in rows if row[fields.index("Lat")] is not None][0]
+    kmz = KmzWriter.kmzsite(kmzs, lat, lon)
+    for row in rows:
+        index = row[fields.index("Index")]
+        KmzWriter.placemark(kmz, index, "dam" if index.startswith("DAM_") else "reservoir",
+                            zip(fields, row[:-1]), kmlpolygons(row[-1]))
+    return kmz
+
+
+def damsegments(daml, left, top, cellsize):
+
+    # Dam lines of the pretty set as cell edges [site index, row0, col0, row1, col1] on the highland grid
+    index = dict((int(d.split("_")[-1]), k) for k, d in enumerate(daml))
+    if output=="Consolidated":
+        with arcpy.da.SearchCursor("DAMS", ["PPT_ID", "SHAPE@"]) as cursor:
+            rows = [row for row in cursor if row[0] in index]
+    else:
+        rows = [(int(d.split("_")[-1]), readsite(d, ["SHAPE@"])[0]) for d in daml]
+    segments = []
+    for idx, shape in rows:
+        for part in (shape if shape is not None else []):
+            corners = [(int(round((top - p.Y) / cellsize)), int(round((p.X - left) / cellsize))) for p in part if p is not None]
+            segments.extend([index[idx], a[0], a[1], b[0], b[1]] for a, b in zip(corners[:-1], corners[1:]) if (a[0]==b[0])!=(a[1]==b[1]))
+    return segments
+
+
+def outlines(resl, daml, buffer=15, tolerance=90):
+
+    # Smoothed reservoir and dam polygons of the pretty set in one batch (OutlineArray), by index in resl:
+    # reservoirs from their footprints, dams as strips of buffer metres outside their cell edges; tolerance in metres
+    path = os.path.join(directory, footprints)
+    cellsets, grid = SetArray.loadfootprints(path), SetArray.loadgrid(path)
+    assert grid is not None, "Run DryGully again to save the grid with the footprints."
+    missing = [r for r in resl if int(r.split("_")[-1]) not in cellsets]
+    assert not missing, "No footprint of " + ", ".join(missing[:10])
+    left, top, cellsize, rows, cols = grid
+    metres = GullyArray.rowgeometry(top, cellsize, 1)["height"][0]
+    factor = max(1, int(round(metres / buffer)))
+
+    site, cell = OutlineArray.runcells([cellsets[int(r.split("_")[-1])] for r in resl])
+    sites, ptr, vertices = OutlineArray.trace(site, cell, rows, cols)
+    reservoirs = OutlineArray.polygons(sites, ptr, OutlineArray.smooth(ptr, vertices, tolerance / metres), left, top, cellsize)
+    damsite, damcell = OutlineArray.damstrip(site, cell, damsegments(daml, left, top, cellsize), rows, cols, factor)
+    sites, ptr, vertices = OutlineArray.trace(damsite, damcell, rows * factor, cols * factor)
+    dams = OutlineArray.polygons(sites, ptr, OutlineArray.smooth(ptr, vertices, tolerance * factor / metres), left, top, cellsize / factor)
+    return reservoirs, dams
+
+
+def arcpolygon(parts, sr):
+
+    # Polygon of [[outer ring, hole, ...], ...] (outer rings anticlockwise): rings reversed, outer rings clockwise as ArcGIS draws them
+    return arcpy.Polygon(arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in ring[::-1]]) for rings in parts for ring in rings]), sr)
+
+
+def resdambatch(resl, daml, kmzs):
+
+    # All sites of the pretty set at once: polygons from OutlineArray into RESDAM with one insert cursor
+    # Streamed KMZs take the polygons as they are: the highland grid is geographic, close enough to WGS84 for review
+    reservoirs, dams = outlines(resl, daml)
+    sr = arcpy.Describe(siteset(resl[0])).spatialReference if resl else None
+    arcpy.CreateFeatureclass_management(arcpy.env.workspace, "RESDAM", "POLYGON", spatial_reference=sr)
+    for f in SiteStore.sitefields:
+        arcpy.AddField_management(in_table="RESDAM", field_name=f, field_type="DOUBLE")
+    arcpy.AddField_management(in_table="RESDAM", field_name="Index", field_type="TEXT")
+
+    # Attributes of the reservoirs from the store (or each RES_), rounded
+    sites = SiteStore.fetch(os.path.join(directory, store)) if store and os.path.exists(os.path.join(directory, store)) else {}
+    with arcpy.da.InsertCursor("RESDAM", SiteStore.sitefields + ["Index", "SHAPE@"]) as cursor:
+        for k in range(len(resl)):
+            site = sites.get(int(resl[k].split("_")[-1])) or dict(zip(SiteStore.sitefields, readsite(resl[k], SiteStore.sitefields)))
+            values = [int(float(site[f])) if f in integerfd else round(float(site[f]), 1) if f in floatfd else site[f]
+                      for f in SiteStore.sitefields]
+            if k in dams:
+                cursor.insertRow([None] * len(values) + [daml[k], arcpolygon(dams[k], sr)])
+            cursor.insertRow(values + [resl[k], arcpolygon(reservoirs[k], sr)])
+            if kmzs is not None:
+                kmz = KmzWriter.kmzsite(kmzs, float(site["Lat"]), float(site["Long"]))
+                if k in dams:
+                    KmzWriter.placemark(kmz, daml[k], "dam", [("Index", daml[k])], dams[k])
+                KmzWriter.placemark(kmz, resl[k], "reservoir", zip(SiteStore.sitefields, values) + [("Index", resl[k])], reservoirs[k])
+    print "RESDAM saved (" + str(len(resl)) + " sites)"
+
+    # Per site: a KMZ of the rows of each site in RESDAM
+    if kmzs is None:
+        for k in range(len(resl)):
+            lyrresdam = arcpy.MakeFeatureLayer_management(in_features="RESDAM", out_layer="RESDAM_" + resl[k].split("_")[-1],
+                                                          where_clause="Index IN ('" + resl[k] + "', '" + daml[k] + "')")
+            arcpy.LayerToKML_conversion(layer=lyrresdam, out_kmz_file=os.path.join(directory, "RESDAM_" + resl[k].split("_")[-1] + ".kmz"))
+            print "RESDAM_" + resl[k].split("_")[-1] + ".kmz saved"
+
+
+def resdamsites(resl, daml, kmzs):
+
+    # One site at a time: Buffer/Erase/Merge/SmoothPolygon into RESDAM_1234_FC
     for k in range(len(resl)):
         assert resl[k].split("_")[-1]==daml[k].split("_")[-1]
         try:
+            res, dam = siteset(resl[k]), siteset(daml[k])
 
             # Dam polyline converted into polygon
-            dampgon = arcpy.Buffer_analysis(in_features=daml[k], out_feature_class="dambuffer",
+            dampgon = arcpy.Buffer_analysis(in_features=dam, out_feature_class="dambuffer",
                                             buffer_distance_or_field="15 Meters", line_side="FULL", line_end_type="FLAT")
 
             # Erase underwater dam section
-            dampgon = arcpy.Erase_analysis(in_features=dampgon, erase_features=resl[k], out_feature_class="damerase") # + resl[k].split("_")[-1]) if needed
+            dampgon = arcpy.Erase_analysis(in_features=dampgon, erase_features=res, out_feature_class="damerase") # + resl[k].split("_")[-1]) if needed
 
             # Add Field to dam
             arcpy.AddField_management(in_table=dampgon, field_name="Index", field_type="TEXT")
-            arcpy.CalculateField_management(in_table=dampgon, field="Index", expression='"{0}"'.format(daml[k]), expression_type="PYTHON")
-
-            # Add Field to reservoir
-            arcpy.AddField_management(in_table=resl[k], field_name="Index", field_type="TEXT")
-            arcpy.CalculateField_management(in_table=resl[k], field="Index", expression='"{0}"'.format(resl[k]), expression_type="PYTHON")
-
-            # Rounding
-            integerfd = ["Water_area_ha", "Ground_area_ha", "Reservoir_volume_GL", "Dam_length_m", "Water_rock_ratio"]
-            floatfd = ["Dam_area_ha", "Dam_volume_GL"]
-            for fd in integerfd + floatfd:
-                cursor = arcpy.SearchCursor(resl[k])
-                row = cursor.next()
-                if fd in integerfd:
-                    fdvalue = int(float(row.getValue(fd)))
-                elif fd in floatfd:
-                    fdvalue = round(float(row.getValue(fd)), 1)
-                arcpy.CalculateField_management(in_table=resl[k], field=fd, expression='"{0}"'.format(fdvalue), expression_type="PYTHON")
+            with arcpy.da.UpdateCursor(dampgon, ["Index"]) as cursor:
+                for row in cursor:
+                    cursor.updateRow([daml[k]])
+
+            # Add Field to reservoir (RES_ written by DryGully from its template already has it)
+            if not arcpy.ListFields(res, "Index"):
+                arcpy.AddField_management(in_table=res, field_name="Index", field_type="TEXT")
+
+            # Rounding, in memory and in one update cursor pass with the Index
+            with arcpy.da.UpdateCursor(res, ["Index"] + integerfd + floatfd) as cursor:
+                for row in cursor:
+                    values = [resl[k]] + [int(float(v)) for v in row[1:len(integerfd) + 1]] + [round(float(v), 1) for v in row[len(integerfd) + 1:]]
+                    cursor.updateRow([str(v) if isinstance(row[i], basestring) else v for i, v in enumerate(values)]) # TEXT fields of older RES_
 
             # Attach dams to reservoirs
             # Note. "Union" creates 3 polygons while "Spatial Join" creates only 1; "Dissolve" aggregates features based on specified attributes.
-            resdam = arcpy.Merge_management(inputs=[dampgon, resl[k]], output="resdammerge")
+            resdam = arcpy.Merge_management(inputs=[dampgon, res], output="resdammerge")
 
             # Delete Field
             AllField = [str(f.name) for f in arcpy.ListFields(resdam)]
@@ -152,6 +339,12 @@ def resdamcr8():
             resdam = arcpy.SmoothPolygon_cartography(in_features=resdam, out_feature_class="RESDAM_" + resl[k].split("_")[-1] + "_FC",
                                                      algorithm="PAEK", tolerance="90 Meters")
 
+            # Streamed: append the site to the KMZ of its region
+            if kmzs is not None:
+                kmz = streamkmz(kmzs, resdam, [f for f in FieldList if f not in ["OBJECTID", "Shape", "Shape_Length", "Shape_Area"]])
+                print "RESDAM_" + resl[k].split("_")[-1] + " streamed (" + str(kmz["placemarks"]) + " placemarks)"
+                continue
+
             # Create a KMZ file
             # layer.showLabels = True
             # http://desktop.arcgis.com/en/arcmap/10.3/manage-data/kml/creating-kml-in-arcgis-for-desktop.htm
@@ -164,6 +357,26 @@ def resdamcr8():
         except arcpy.ExecuteError as err:
             print "ArcPy ExecuteError: {0}".format(err)
             continue
+
+
+def resdamcr8():
+
+    # Lists of reservoirs and dams in the pretty set
+    resl, daml = removalindexed() if resolver=="Indexed" else removal()
+
+    # Streamed: one KMZ (or one per region) written site by site
+    kmzs = KmzWriter.kmzset(directory, "RESDAM", kmlregion) if kml=="Streamed" else None
+
+    # NumPy: every site in one batch
+    if geometryengine=="NumPy":
+        resdambatch(resl, daml, kmzs)
+    else:
+        resdamsites(resl, daml, kmzs)
+
+    # Close the streamed KMZs
+    if kmzs is not None:
+        for name, placemarks in sorted(KmzWriter.kmzcloseall(kmzs).items()):
+            print name + " saved (" + str(placemarks) + " placemarks)"
         
 
 if __name__=="__main__":
@@ -0,0 +1,109 @@
+# NumPy engines of PrettySet.removal: sites bucketed in a grid so only nearby pairs get an exact overlap test, made on
+# the cell runs of the reservoir footprints (footprints.npz) saved by DryGully; the greedy order of removal is kept.
+# Bug reports to: bin.lu@anu.edu.au
+
+import numpy as np
+
+
+def gridindex(lat, lon, size):
+
+    # Bucket the sites in a grid of size degrees: {(row, col): [site indices in ascending order]}
+    buckets = {}
+    for k, key in enumerate(zip(np.floor(np.asarray(lat) / size).astype(np.int64).tolist(),
+                                np.floor(np.asarray(lon) / size).astype(np.int64).tolist())):
+        buckets.setdefault(key, []).append(k)
+    return buckets
+
+
+def candidates(i, lat, lon, bbox, buckets, size, near):
+
+    # Later sites within near degrees of site i (as removal's "Accelerate the Combinations") whose boxes touch it
+    # bbox columns: xmin, ymin, xmax, ymax
+    row, col = int(np.floor(lat[i] / size)), int(np.floor(lon[i] / size))
+    found = []
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            found.extend(buckets.get((row + dr, col + dc), []))
+    found = np.array(sorted(j for j in found if j>i), dtype=np.int64)
+    if found.size==0:
+        return found
+    keep = (np.abs(lat[found] - lat[i])<=near) & (np.abs(lon[found] - lon[i])<=near)
+    keep &= (bbox[found, 0]<=bbox[i, 2]) & (bbox[i, 0]<=bbox[found, 2])
+    keep &= (bbox[found, 1]<=bbox[i, 3]) & (bbox[i, 1]<=bbox[found, 3])
+    return found[keep]
+
+
+def overlapremoval(lat, lon, bbox, ratio, intersects, near=0.02):
+
+    # Greedy removal of overlapping sites by water-rock ratio, in the order of PrettySet.removal
+    # intersects(i, j) is the exact test of sites i and j; return the removal indices in the order they are removed
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    bbox, ratio = np.asarray(bbox, dtype=np.float64).reshape(-1, 4), np.asarray(ratio, dtype=np.float64)
+    size = near * 1.001 # Neighbours within near degrees always fall in adjacent buckets
+    buckets = gridindex(lat, lon, size)
+    removed = np.zeros(lat.size, dtype=np.bool_)
+    rmvl = []
+    for i in range(lat.size - 1):
+        if removed[i]:
+            continue
+        for j in candidates(i, lat, lon, bbox, buckets, size, near):
+            if removed[j] or not intersects(i, j):
+                continue
+
+            # Note the "worse" one in rmvl
+            if ratio[i]>=ratio[j]:
+                removed[j] = True
+                rmvl.append(int(j))
+            else:
+                removed[i] = True
+                rmvl.append(i)
+                break
+    return rmvl
+
+
+def cellruns(mask, row0, col0, cols):
+
+    # Footprint of a mask whose first cell is (row0, col0) on a grid of cols columns:
+    # sorted runs [start, end) of linear cell indices, one per row segment
+    edges = np.diff(np.pad(mask.astype(np.int8), ((0, 0), (1, 1)), mode="constant"), axis=1)
+    rows, starts = np.nonzero(edges==1)
+    ends = np.nonzero(edges==-1)[1]
+    base = (row0 + rows.astype(np.int64)) * cols + col0
+    return np.column_stack([base + starts, base + ends]).astype(np.int64).reshape(-1, 2)
+
+
+def runsoverlap(a, b):
+
+    # Whether two footprints share a cell: for each run of a, only the last run of b starting before its end can overlap it
+    if len(a)==0 or len(b)==0:
+        return False
+    k = np.searchsorted(b[:, 0], a[:, 1], side="left") - 1
+    found = k>=0
+    return bool((b[k[found], 1]>a[found, 0]).any())
+
+
+def savefootprints(path, footprints, grid=None):
+
+    # Save {id: runs} in one .npz: runs of id ids[k] are runs[ptr[k]:ptr[k + 1]]
+    # grid: left, top, cell size, rows and columns of the highland grid, for drawing the footprints
+    ids = sorted(footprints)
+    ptr = np.concatenate([[0], np.cumsum([len(footprints[i]) for i in ids])]).astype(np.int64)
+    runs = np.concatenate([footprints[i] for i in ids]) if ids else np.zeros((0, 2), dtype=np.int64)
+    np.savez(path, ids=np.array(ids, dtype=np.int64), ptr=ptr, runs=runs,
+             grid=np.array(grid if grid is not None else [], dtype=np.float64))
+
+
+def loadfootprints(path):
+
+    # Open saved footprints as {id: runs}
+    with np.load(path) as saved:
+        ids, ptr, runs = saved["ids"], saved["ptr"], saved["runs"]
+    return dict((int(i), runs[ptr[k]:ptr[k + 1]]) for k, i in enumerate(ids))
+
+
+def loadgrid(path):
+
+    # Grid of saved footprints: (left, top, cell size, rows, columns), None if saved without it
+    with np.load(path) as saved:
+        grid = saved["grid"].tolist() if "grid" in saved.files else []
+    return (grid[0], grid[1], grid[2], int(grid[3]), int(grid[4])) if grid else None
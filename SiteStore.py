@@ -0,0 +1,57 @@
+# SQLite store of the screened sites (sites.sqlite) - written by DryGully.screen in batches, read by PrettySet in one query.
+# Typed columns replace the untyped rows of records.csv; WAL journaling lets readers query a store that is being written.
+# Bug reports to: bin.lu@anu.edu.au
+
+import csv
+import sqlite3
+
+# Columns of a site: the fields of RES_ and the bounding box of the reservoir polygon
+sitefields = ["Lat", "Long", "Elevation_m", "Water_area_ha", "Ground_area_ha", "Reservoir_volume_GL",
+              "Dam_length_m", "Dam_area_ha", "Dam_volume_GL", "Water_rock_ratio"]
+fields = sitefields + ["XMin", "YMin", "XMax", "YMax"]
+
+
+def connect(path):
+
+    # Open (and create if needed) the store
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS sites (OBJECTID INTEGER PRIMARY KEY, " +
+                 ", ".join(f + " REAL" for f in fields) + ")")
+    conn.execute("CREATE INDEX IF NOT EXISTS sites_location ON sites (Lat, Long)")
+    conn.execute("CREATE INDEX IF NOT EXISTS sites_ratio ON sites (Water_rock_ratio)")
+    conn.commit()
+    return conn
+
+
+def insert(conn, records):
+
+    # Write a batch of sites ({"OBJECTID": ..., field: value}) in one transaction; a site screened again is replaced
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO sites (OBJECTID, " + ", ".join(fields) + ") VALUES (" +
+                         ", ".join(["?"] * (len(fields) + 1)) + ")",
+                         [[int(r["OBJECTID"])] + [float(r[f]) if r.get(f) is not None else None for f in fields] for r in records])
+
+
+def fetch(path, where="", args=()):
+
+    # All sites (or those matching a WHERE clause) in one query: {OBJECTID: {field: value}}
+    conn = connect(path)
+    try:
+        rows = conn.execute("SELECT OBJECTID, " + ", ".join(fields) + " FROM sites " +
+                            ("WHERE " + where if where else "") + " ORDER BY OBJECTID", args).fetchall()
+    finally:
+        conn.close()
+    return dict((row[0], dict(zip(fields, row[1:]))) for row in rows)
+
+
+def exportcsv(path, csvpath):
+
+    # Write the store as records.csv with a header, one site per row in OBJECTID order
+    sites = fetch(path)
+    with open(csvpath, "w") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["RES"] + fields)
+        for oid in sorted(sites):
+            writer.writerow(["RES_" + str(oid)] + [sites[oid][f] for f in fields])
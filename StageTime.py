@@ -0,0 +1,111 @@
+# Timing of the screening stages - named spans around each step, written as a JSON-lines trace (trace.jsonl).
+# Events are buffered per process: workers return them with their results and the parent writes them with the journal.
+# The summary (per-stage totals, per-point latency histogram, accepted/rejected/errored counts) is read off the trace.
+# Bug reports to: bin.lu@anu.edu.au
+
+import os
+import csv
+import json
+import timeit
+import contextlib
+
+# Latency bins (seconds) of the per-point histogram
+bins = [0.1, 0.3, 1, 3, 10, 30, 100]
+
+# Buffered events, the current pour point and whether spans are timed
+events = []
+current = {"point": None, "start": None}
+enabled = {"on": True}
+
+
+@contextlib.contextmanager
+def span(stage):
+
+    # Time a named stage of the current pour point
+    if not enabled["on"]:
+        yield
+        return
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        events.append({"type": "span", "point": current["point"], "stage": stage, "pid": os.getpid(),
+                       "seconds": timeit.default_timer() - start})
+
+
+def begin(point):
+
+    # Start the latency of a pour point; its spans are tagged with it
+    current["point"], current["start"] = point, timeit.default_timer()
+
+
+def end(status):
+
+    # Close the pour point with its status ("accepted", "rejected" or "errored")
+    if enabled["on"] and current["start"] is not None:
+        events.append({"type": "point", "point": current["point"], "status": status, "pid": os.getpid(),
+                       "seconds": timeit.default_timer() - current["start"]})
+    current["point"], current["start"] = None, None
+
+
+def drain():
+
+    # Hand over the buffered events (e.g. from a worker to the parent) and clear them
+    drained = events[:]
+    del events[:]
+    return drained
+
+
+def merge(drained):
+
+    # Take over the events of a worker
+    events.extend(drained)
+
+
+def write(path, drained):
+
+    # Append events to the trace
+    if drained:
+        with open(path, "a") as trace:
+            for event in drained:
+                trace.write(json.dumps(event) + "\n")
+
+
+def summary(path):
+
+    # Per-stage totals, the per-point latency histogram and the status counts of a trace
+    stages, latency, status = {}, [0] * (len(bins) + 1), {}
+    with open(path, "r") as trace:
+        for line in trace:
+            event = json.loads(line)
+            if event["type"]=="span":
+                total = stages.setdefault(event["stage"], [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += event["seconds"]
+                total[2] = max(total[2], event["seconds"])
+            else:
+                latency[sum(1 for b in bins if event["seconds"]>=b)] += 1
+                status[event["status"]] = status.get(event["status"], 0) + 1
+    return stages, latency, status
+
+
+def table(path, csvpath=None):
+
+    # Summary table of a trace, hottest stage first; written as CSV too if csvpath is given
+    stages, latency, status = summary(path)
+    whole = sum(s[1] for s in stages.values()) or 1.0
+    rows = [["Stage", "Calls", "Total_s", "Mean_ms", "Max_ms", "Share_%"]]
+    for stage in sorted(stages, key=lambda s: -stages[s][1]):
+        calls, total, most = stages[stage]
+        rows.append([stage, calls, round(total, 3), round(1000 * total / calls, 1), round(1000 * most, 1), round(100 * total / whole, 1)])
+    edges = ["<" + str(bins[0]) + " s"] + [str(bins[k]) + "-" + str(bins[k + 1]) + " s" for k in range(len(bins) - 1)] + [">=" + str(bins[-1]) + " s"]
+    rows.append([])
+    rows.append(["Latency", "Points"])
+    rows.extend([edge, count] for edge, count in zip(edges, latency))
+    rows.append([])
+    rows.append(["Status", "Points"])
+    rows.extend([s, status[s]] for s in sorted(status))
+    if csvpath is not None:
+        with open(csvpath, "w") as csvfile:
+            csv.writer(csvfile).writerows(rows)
+    return "\n".join("  ".join(str(x).ljust(20) if k==0 else str(x).rjust(10) for k, x in enumerate(row)) for row in rows)